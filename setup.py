@@ -28,6 +28,7 @@ setup(
     packages=['upyun', 'upyun.modules'],
     keywords=['upyun', 'python', 'sdk'],
     install_requires=['requests>=2.4.3'],
+    extras_require={'async': ['aiohttp>=3.0']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
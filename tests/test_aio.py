@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import base64
+import hashlib
+import tempfile
+import asyncio
+import unittest
+
+curpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, curpath)
+
+import upyun
+from upyun.modules.sign import make_rest_signature
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+BUCKET = 'bucket'
+USERNAME = 'username'
+PASSWORD = 'password'
+SECRET = 'secret'
+PASSWORD_MD5 = hashlib.md5(PASSWORD.encode('utf-8')).hexdigest()
+
+
+class StandInServer(object):
+    '''A tiny in-memory UPYUN look-alike, only checks the rest signature.'''
+
+    def __init__(self):
+        self.store = {}
+        self.faults = 0
+        self.app = web.Application()
+        self.app.router.add_route('*', '/{tail:.*}', self.dispatch)
+
+    def key(self, request):
+        return request.path[len('/%s' % BUCKET):].rstrip('/') or '/'
+
+    async def dispatch(self, request):
+        if self.faults:
+            self.faults -= 1
+            return web.Response(status=503, text='busy',
+                                headers={'Retry-After': '0'})
+        if request.path.startswith('/pretreatment/'):
+            return web.json_response(['taskid'])
+        if request.path.startswith('/status/'):
+            return web.json_response({'tasks': {'taskid': 100}})
+        if request.method == 'POST' and request.path == '/%s/' % BUCKET:
+            form = await request.post()
+            policy = json.loads(base64.b64decode(form['policy']).decode())
+            self.store[policy['save-key']] = form['file'].file.read()
+            return web.json_response({'code': 200})
+
+        length = request.headers.get('Content-Length', 0)
+        expected = make_rest_signature(BUCKET, USERNAME, PASSWORD_MD5,
+                                       request.method, request.raw_path,
+                                       request.headers['Date'], length)
+        if request.headers.get('Authorization') != expected:
+            return web.Response(status=401, text='sign error')
+
+        key = self.key(request)
+        if request.method == 'PUT':
+            self.store[key] = await request.read()
+            return web.Response(headers={'x-upyun-width': '1'})
+        if request.method == 'POST':
+            self.store[key] = None
+            return web.Response()
+        if key not in self.store:
+            return web.Response(status=404, text='not found')
+        value = self.store[key]
+        if request.method == 'DELETE':
+            del self.store[key]
+            return web.Response()
+        if request.method == 'HEAD':
+            if value is None:
+                return web.Response(headers={'x-upyun-file-type': 'folder'})
+            return web.Response(headers={
+                'x-upyun-file-type': 'file',
+                'x-upyun-file-size': str(len(value))})
+        if value is None:
+            prefix = key + '/'
+            lines = ['%s\t%s\t%d\t0' % (k[len(prefix):],
+                                        'F' if v is None else 'N',
+                                        len(v or b''))
+                     for k, v in sorted(self.store.items())
+                     if k.startswith(prefix)]
+            return web.Response(text='\n'.join(lines))
+        return web.Response(body=value)
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class TestAsyncUpYun(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = StandInServer()
+        self.runner = web.AppRunner(self.server.app)
+        self.wait(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.wait(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = '127.0.0.1:%d' % port
+        self.up = upyun.AsyncUpYun(BUCKET, USERNAME, PASSWORD, SECRET,
+                                   endpoint=self.endpoint)
+
+    def tearDown(self):
+        self.wait(self.up.close())
+        self.wait(self.runner.cleanup())
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_put_get_delete(self):
+        res = self.wait(self.up.put('/dir/test.txt', 'abcdefghijklmn\n'))
+        self.assertDictEqual(res, {'width': '1'})
+        self.assertEqual(self.wait(self.up.get('/dir/test.txt')),
+                         'abcdefghijklmn\n')
+        f = io.BytesIO()
+        self.wait(self.up.get('/dir/test.txt', f))
+        self.assertEqual(f.getvalue(), b'abcdefghijklmn\n')
+        self.wait(self.up.delete('/dir/test.txt'))
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            self.wait(self.up.getinfo('/dir/test.txt'))
+        self.assertEqual(se.exception.status, 404)
+
+    def test_put_file(self):
+        with open('tests/test.png', 'rb') as f:
+            self.wait(self.up.put('/test.png', f, checksum=True))
+        res = self.wait(self.up.getinfo('/test.png'))
+        self.assertDictEqual(res, {'file-type': 'file', 'file-size': '13001'})
+
+    def test_mkdir_getlist(self):
+        self.wait(self.up.mkdir('/dir'))
+        self.wait(self.up.put('/dir/a.txt', 'a'))
+        self.wait(self.up.mkdir('/dir/sub'))
+        res = self.wait(self.up.getlist('/dir'))
+        self.assertEqual([r['name'] for r in res], ['a.txt', 'sub'])
+        self.assertDictEqual(self.wait(self.up.getinfo('/dir')),
+                             {'file-type': 'folder'})
+
+    def test_auth_failed(self):
+        up = upyun.AsyncUpYun(BUCKET, USERNAME, 'wrong',
+                              endpoint=self.endpoint)
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            self.wait(up.getinfo('/'))
+        self.assertEqual(se.exception.status, 401)
+        self.wait(up.close())
+
+    def test_client_exception(self):
+        up = upyun.AsyncUpYun(BUCKET, USERNAME, PASSWORD,
+                              endpoint='127.0.0.1:1')
+        with self.assertRaises(upyun.UpYunClientException):
+            self.wait(up.getinfo('/'))
+        self.wait(up.close())
+        with self.assertRaises(upyun.UpYunClientException):
+            self.wait(upyun.AsyncUpYun(BUCKET).getinfo('/'))
+
+    def test_concurrent_requests(self):
+        async def fanout():
+            await self.up.put('/hot.txt', 'hot')
+            return await asyncio.gather(*[self.up.getinfo('/hot.txt')
+                                          for _ in range(1000)])
+        res = self.wait(fanout())
+        self.assertEqual(len(res), 1000)
+        self.assertEqual(res[-1]['file-size'], '3')
+
+    def test_put_form(self):
+        with open('tests/test.png', 'rb') as f:
+            res = self.wait(self.up.put('/form.png', f, form=True))
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(len(self.server.store['/form.png']), 13001)
+
+    def test_debug_logger(self):
+        records = []
+        logger = upyun.DebugLogger(sink=records.append)
+        up = upyun.AsyncUpYun(BUCKET, USERNAME, PASSWORD,
+                              endpoint=self.endpoint, debug=logger)
+        with self.assertRaises(upyun.UpYunServiceException):
+            self.wait(up.getinfo('/missing'))
+        self.wait(up.close())
+        logger.close()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['status'], 404)
+        self.assertEqual(records[0]['error'], 'Not Found')
+        self.assertEqual(records[0]['headers']['Authorization'], '******')
+
+    def test_truthy_debug(self):
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            up = upyun.AsyncUpYun(BUCKET, USERNAME, PASSWORD,
+                                  endpoint=self.endpoint, debug=1)
+            self.assertIsInstance(up.debug, upyun.DebugLogger)
+            self.wait(up.close())
+            up.debug.close()
+        finally:
+            os.chdir(cwd)
+            os.remove(os.path.join(tmp, 'debug.log'))
+            os.rmdir(tmp)
+
+    def test_retry(self):
+        self.wait(self.up.put('/retry.txt', 'abc'))
+        self.server.faults = 2
+        res = self.wait(self.up.getinfo('/retry.txt'))
+        self.assertEqual(res['file-size'], '3')
+        self.assertEqual(self.up.hp.retry.retries, 2)
+
+        # - PUT is not idempotent by default
+        self.server.faults = 1
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            self.wait(self.up.put('/retry.txt', 'abc'))
+        self.assertEqual(se.exception.status, 503)
+
+        up = upyun.AsyncUpYun(BUCKET, USERNAME, PASSWORD,
+                              endpoint=self.endpoint,
+                              retry=upyun.RetryPolicy(total=1))
+        self.server.faults = 2
+        with self.assertRaises(upyun.UpYunServiceException):
+            self.wait(up.getinfo('/retry.txt'))
+        self.assertEqual(up.hp.retry.retries, 1)
+        self.wait(up.close())
+
+    def test_pretreat(self):
+        self.up.av.HOST = self.endpoint
+        ids = self.wait(self.up.pretreat([{'type': 'probe'}], '/test.mp4'))
+        self.assertListEqual(ids, ['taskid'])
+        self.assertDictEqual(self.wait(self.up.status(ids)), {'taskid': 100})
@@ -0,0 +1,678 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import socket
+import time
+import base64
+import email
+import gc
+import hashlib
+import tempfile
+import threading
+import unittest
+import weakref
+
+curpath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, curpath)
+
+import upyun
+from upyun.modules.pool import WorkerPool
+from upyun.modules.sign import make_rest_signature, make_multipart_md5,\
+    make_content_md5
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+BUCKET = 'bucket'
+USERNAME = 'username'
+PASSWORD = 'password'
+SECRET = 'secret'
+PASSWORD_MD5 = hashlib.md5(PASSWORD.encode('utf-8')).hexdigest()
+
+
+def parse_form(ctype, body):
+    '''Return the fields of a multipart/form-data body.'''
+    head = ('Content-Type: %s\r\n\r\n' % ctype).encode('ascii')
+    parse = getattr(email, 'message_from_bytes', email.message_from_string)
+    return dict((part.get_param('name', header='content-disposition'),
+                 part.get_payload(decode=True))
+                for part in parse(head + body).get_payload())
+
+
+def load_policy(policy):
+    if isinstance(policy, bytes):
+        policy = policy.decode('ascii')
+    return json.loads(base64.b64decode(policy).decode('utf-8'))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_HEAD(self):
+        self.server.stand_in.dispatch(self)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # - clients giving up on a response are expected
+        pass
+
+
+class StandInServer(object):
+    '''A tiny in-memory UPYUN look-alike for the blocking client, only
+    checks the rest signature.
+    '''
+
+    def __init__(self):
+        self.store = {}
+        self.uploads = {}
+        self.blocks = []
+        self.block_faults = {}
+        self.range_faults = {}
+        self.range_delay = 0
+        self.ignore_range = False
+        self.gets = 0
+        self.partial_status = False
+        self.lock = threading.Lock()
+        self.httpd = ThreadedServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.stand_in = self
+        self.endpoint = '127.0.0.1:%d' % self.httpd.server_address[1]
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def dispatch(self, req):
+        body = req.body()
+        if req.command == 'POST' and req.path == '/%s/' % BUCKET:
+            return self.multipart(req, body)
+
+        expected = make_rest_signature(BUCKET, USERNAME, PASSWORD_MD5,
+                                       req.command, req.path,
+                                       req.headers.get('Date', ''),
+                                       req.headers.get('Content-Length', 0))
+        if req.headers.get('Authorization') != expected:
+            return req.reply(401, b'sign error')
+
+        key = req.path[len('/%s' % BUCKET):].rstrip('/') or '/'
+        if req.command == 'PUT':
+            self.store[key] = body
+            return req.reply(200)
+        if key not in self.store:
+            return req.reply(404, b'not found')
+        value = self.store[key]
+        if req.command == 'HEAD':
+            return req.reply(200, headers={
+                'x-upyun-file-type': 'file',
+                'x-upyun-file-size': len(value),
+                'ETag': '"%s"' % hashlib.md5(value).hexdigest()})
+        if req.command == 'DELETE':
+            del self.store[key]
+            return req.reply(200)
+        rng = req.headers.get('Range')
+        with self.lock:
+            self.gets += 1
+        if not rng or self.ignore_range:
+            return req.reply(200, value)
+        start, end = [int(x) for x in rng.split('=')[1].split('-')]
+        if start in self.range_faults:
+            return req.reply(self.range_faults[start], b'range fault')
+        time.sleep(self.range_delay)
+        return req.reply(206, value[start:end + 1], {
+            'Content-Range': 'bytes %d-%d/%d' % (start, end, len(value))})
+
+    def multipart(self, req, body):
+        ctype = req.headers['Content-Type']
+        if ctype.startswith('multipart/form-data'):
+            form = parse_form(ctype, body)
+            policy = load_policy(form['policy'])
+            upload = self.uploads.get(policy['save_token'])
+            if upload is None:
+                return req.reply(403, b'save_token expired')
+            index = policy['block_index']
+            with self.lock:
+                self.blocks.append(index)
+                faults = self.block_faults.get(index)
+                if faults:
+                    return req.reply(faults.pop(0), b'block fault')
+                upload['blocks'][index] = form['file']
+            status = upload['status']()
+            if self.partial_status:
+                # - only this block reported as saved
+                status = [int(i == index) for i in range(len(status))]
+            return req.reply(200, {'status': status,
+                                   'save_token': policy['save_token']})
+
+        form = parse_qs(body.decode('ascii'))
+        policy = load_policy(form['policy'][0])
+        if 'save_token' in policy:
+            upload = self.uploads.pop(policy['save_token'])
+            data = b''.join(upload['blocks'][i]
+                            for i in range(upload['count']))
+            self.store[upload['path']] = data
+            return req.reply(200, {'path': upload['path']})
+
+        token = 'token%d' % len(self.uploads)
+        count = policy['file_blocks']
+        upload = {'path': policy['path'], 'count': count, 'blocks': {}}
+        upload['status'] = lambda: [int(i in upload['blocks'])
+                                    for i in range(count)]
+        self.uploads[token] = upload
+        return req.reply(200, {'save_token': token, 'token_secret': 'ts',
+                               'status': upload['status']()})
+
+
+class LocalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, SECRET,
+                              endpoint=self.server.endpoint,
+                              retry=upyun.RetryPolicy(backoff_factor=0))
+        self.up.up_multi.host = self.server.endpoint
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        for name in os.listdir(self.tmp):
+            os.remove(os.path.join(self.tmp, name))
+        os.rmdir(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+
+class TestMultipart(LocalTestCase):
+    def setUp(self):
+        super(TestMultipart, self).setUp()
+        self.up.up_multi.retry = upyun.RetryPolicy(
+            total=5, methods=('POST',), backoff_factor=0)
+        self.data = os.urandom(450 * 1024)
+        with open(self.path('multi.bin'), 'wb') as f:
+            f.write(self.data)
+
+    def put(self, **kwargs):
+        with open(self.path('multi.bin'), 'rb') as f:
+            return self.up.put('/multi.bin', f, multipart=True,
+                               block_size=100 * 1024, concurrency=1,
+                               **kwargs)
+
+    def test_block_retry(self):
+        self.server.block_faults[2] = [503, 500]
+        self.put()
+        self.assertEqual(self.server.store['/multi.bin'], self.data)
+        self.assertEqual(self.server.blocks, [0, 1, 2, 2, 2, 3, 4])
+
+    def test_block_retry_exhausted(self):
+        self.server.block_faults[2] = [503] * 10
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            self.put()
+        self.assertEqual(se.exception.status, 503)
+        # - one attempt and five retries, no retries of the http layer
+        self.assertEqual(self.server.blocks, [0, 1] + [2] * 6)
+        self.assertNotIn('/multi.bin', self.server.store)
+
+    def test_status_merge(self):
+        self.server.partial_status = True
+        self.put()
+        self.assertEqual(self.server.store['/multi.bin'], self.data)
+        self.assertEqual(self.server.blocks, [0, 1, 2, 3, 4])
+
+    def interrupted_put(self, **kwargs):
+        self.server.block_faults[2] = [503] * 6
+        with self.assertRaises(upyun.UpYunServiceException):
+            self.put(journal=self.tmp, **kwargs)
+        self.assertEqual(len(os.listdir(self.tmp)), 2)
+        del self.server.blocks[:]
+
+    def test_journal_resume(self):
+        self.interrupted_put()
+        self.put(journal=self.tmp)
+        self.assertEqual(self.server.store['/multi.bin'], self.data)
+        # - the saved blocks are not sent again
+        self.assertEqual(self.server.blocks, [2, 3, 4])
+        self.assertEqual(os.listdir(self.tmp), ['multi.bin'])
+
+    def test_journal_expired(self):
+        # - sessions about to expire are not resumed
+        self.interrupted_put(expiration=60)
+        self.put(journal=self.tmp)
+        self.assertEqual(self.server.store['/multi.bin'], self.data)
+        self.assertEqual(self.server.blocks, [0, 1, 2, 3, 4])
+
+    def test_journal_restart(self):
+        self.interrupted_put()
+        # - the session is rejected, a new one is started
+        self.server.uploads.clear()
+        self.put(journal=self.tmp)
+        self.assertEqual(self.server.store['/multi.bin'], self.data)
+        self.assertEqual(self.server.blocks, [0, 1, 2, 3, 4])
+        self.assertEqual(os.listdir(self.tmp), ['multi.bin'])
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_close_wait(self):
+        pool = WorkerPool(2)
+        done = []
+
+        def work(i):
+            time.sleep(0.1)
+            done.append(i)
+            if i == 0:
+                raise ValueError(i)
+
+        results = pool.imap_unordered(work, range(10))
+        for _, _, error in results:
+            if error is not None:
+                break
+        results.close()
+        pool.close(wait=True)
+        finished = list(done)
+        time.sleep(0.2)
+        # - nothing ran after close returned, queued items were skipped
+        self.assertEqual(done, finished)
+        self.assertLess(len(done), 10)
+
+    def test_base_exception(self):
+        pool = WorkerPool(1)
+
+        def work(i):
+            if i == 0:
+                raise KeyboardInterrupt
+            return i
+
+        res = sorted((item, error.__class__)
+                     for item, _, error in pool.imap_unordered(work, range(3)))
+        pool.close(wait=True)
+        self.assertEqual(res, [(0, KeyboardInterrupt), (1, type(None)),
+                               (2, type(None))])
+
+
+class TestPut(LocalTestCase):
+    def test_monitor_keeps_mmap(self):
+        monitor = upyun.TransferMonitor()
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD,
+                         endpoint=self.server.endpoint, monitor=monitor)
+        data = os.urandom(300 * 1024)
+        with open(self.path('put.bin'), 'wb') as f:
+            f.write(data)
+        mapped = []
+        map_file = upyun.rest.map_file
+        upyun.rest.map_file = lambda f: mapped.append(f) or map_file(f)
+        try:
+            with open(self.path('put.bin'), 'rb') as f:
+                up.put('/put.bin', f)
+        finally:
+            upyun.rest.map_file = map_file
+        self.assertEqual(len(mapped), 1)
+        self.assertEqual(self.server.store['/put.bin'], data)
+        snapshot = monitor.snapshot()
+        self.assertEqual((snapshot['transfers'], snapshot['active'],
+                          snapshot['bytes'], snapshot['total']),
+                         (1, 0, len(data), len(data)))
+
+    def test_put_many_paths(self):
+        path = self.path('local.txt')
+        with open(path, 'wb') as f:
+            f.write(b'local file')
+        # - strings are content unless told to be paths
+        res = list(self.up.put_many([('/a.txt', path)]))
+        self.assertIsNone(res[0].error)
+        self.assertEqual(self.server.store['/a.txt'], path.encode('utf-8'))
+        res = list(self.up.put_many([('/b.txt', path),
+                                     ('/c.txt', self.path('none'))],
+                                    paths=True))
+        errors = dict((r.key, r.error) for r in res)
+        self.assertIsNone(errors['/b.txt'])
+        self.assertIsInstance(errors['/c.txt'], EnvironmentError)
+        self.assertEqual(self.server.store['/b.txt'], b'local file')
+
+
+class TestBulk(LocalTestCase):
+    def test_shared_pool(self):
+        before = set(threading.enumerate())
+
+        def workers():
+            return [t for t in threading.enumerate()
+                    if t.name == 'upyun-worker' and t not in before]
+        keys = ['/k%d' % i for i in range(20)]
+        seen = set()
+        for _ in range(3):
+            res = list(self.up.put_many([(k, k) for k in keys],
+                                        concurrency=4))
+            self.assertEqual(len(res), 20)
+            seen.update(workers())
+        # - the same threads run every call
+        self.assertEqual(len(seen), 4)
+
+        lock, active, peak = threading.Lock(), [0], [0]
+        getinfo = self.up.up_rest.getinfo
+
+        def counted_getinfo(key):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            try:
+                return getinfo(key)
+            finally:
+                with lock:
+                    active[0] -= 1
+        self.up.up_rest.getinfo = counted_getinfo
+        res = list(self.up.getinfo_many(keys, concurrency=6, window=2))
+        self.assertFalse([r for r in res if r.error])
+        # - grown to the largest concurrency, the window still applies
+        self.assertEqual(len(workers()), 6)
+        self.assertLessEqual(peak[0], 2)
+
+
+class TestMetaCache(LocalTestCase):
+    def test_read_during_put(self):
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD,
+                         endpoint=self.server.endpoint, cache=True)
+        self.server.store['/k'] = b'old'
+        fetched, release = threading.Event(), threading.Event()
+        getinfo = up.up_rest.getinfo
+
+        def slow_getinfo(key):
+            res = getinfo(key)
+            fetched.set()
+            release.wait(5)
+            return res
+        up.up_rest.getinfo = slow_getinfo
+        reader = threading.Thread(target=up.getinfo, args=('/k',))
+        reader.start()
+        try:
+            fetched.wait(5)
+            # - the old metadata arrives after the put invalidated it
+            up.put('/k', 'new content')
+        finally:
+            release.set()
+            reader.join()
+            up.up_rest.getinfo = getinfo
+        self.assertEqual(up.getinfo('/k')['file-size'], '11')
+        self.assertEqual(up.getinfo('/k')['file-size'], '11')
+        self.assertEqual(up.cache_stats()['hits'], 1)
+
+    def test_forgotten_generations(self):
+        cache = upyun.MetaCache(maxsize=2)
+        generation = cache.generation(('info', '/a'))
+        cache.invalidate(('info', '/a'))
+        cache.invalidate(('info', '/b'), ('info', '/c'))
+        # - /a is no longer tracked, but still counts as invalidated
+        cache.set(('info', '/a'), {}, generation)
+        self.assertIsNone(cache.get(('info', '/a')))
+        generation = cache.generation(('info', '/a'))
+        cache.set(('info', '/a'), {}, generation)
+        self.assertEqual(cache.get(('info', '/a')), {})
+
+
+class TestEndpointSelector(LocalTestCase):
+    def test_first_request_not_held_back(self):
+        # - accepts connections but never answers
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(8)
+        hosts = ['127.0.0.1:%d' % silent.getsockname()[1],
+                 self.server.endpoint]
+        selector = upyun.EndpointSelector(hosts, probe_timeout=1)
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, endpoint=selector,
+                         timeout=5)
+        self.server.store['/k'] = b'abc'
+        start = time.time()
+        try:
+            self.assertEqual(up.getinfo('/k')['file-size'], '3')
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(selector.best(), self.server.endpoint)
+            # - the silent host is given up on after probe_timeout
+            time.sleep(1.5)
+            scores = selector.scores()
+            self.assertEqual(scores[hosts[0]]['failures'], 1)
+        finally:
+            silent.close()
+
+
+class TestParallelGet(LocalTestCase):
+    def test_error_stops_workers(self):
+        data = os.urandom(1024 * 1024)
+        self.server.store['/big.bin'] = data
+        self.server.range_faults[0] = 404
+        self.server.range_delay = 0.05
+        before = set(threading.enumerate())
+        with open(self.path('big.bin'), 'wb') as f:
+            with self.assertRaises(upyun.UpYunServiceException):
+                self.up.get('/big.bin', f, parallel=4,
+                            part_size=64 * 1024)
+        # - every range worker is gone once get returns
+        self.assertFalse([t for t in threading.enumerate()
+                          if t.name == 'upyun-worker' and t not in before])
+
+    def test_range_ignored(self):
+        self.server.store['/big.bin'] = os.urandom(256 * 1024)
+        self.server.ignore_range = True
+        with open(self.path('big.bin'), 'wb') as f:
+            with self.assertRaises(upyun.UpYunServiceException) as se:
+                self.up.get('/big.bin', f, parallel=4, part_size=64 * 1024)
+        self.assertEqual(se.exception.status, 200)
+        # - failed at once, no range was asked for twice
+        self.assertLessEqual(self.server.gets, 4)
+
+    def test_resume_stale_checkpoint(self):
+        data = os.urandom(256 * 1024)
+        self.server.store['/big.bin'] = data
+        path = self.path('big.bin')
+        self.server.range_faults[192 * 1024] = 404
+        with self.assertRaises(upyun.UpYunServiceException):
+            self.up.get('/big.bin', path, resume=True, part_size=64 * 1024)
+        self.assertTrue(os.path.exists(path + '.upyun-ckpt'))
+
+        # - the partial file is gone, its checkpoint must not be trusted
+        os.remove(path)
+        del self.server.range_faults[192 * 1024]
+        self.up.get('/big.bin', path, resume=True, part_size=64 * 1024)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(path + '.upyun-ckpt'))
+
+    def test_resume_truncated_file(self):
+        data = os.urandom(256 * 1024)
+        self.server.store['/big.bin'] = data
+        path = self.path('big.bin')
+        self.server.range_faults[192 * 1024] = 404
+        with self.assertRaises(upyun.UpYunServiceException):
+            self.up.get('/big.bin', path, resume=True, part_size=64 * 1024)
+        del self.server.range_faults[192 * 1024]
+        with open(path, 'wb') as f:
+            self.up.get('/big.bin', f, resume=True, part_size=64 * 1024)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class TestMultipartMd5(unittest.TestCase):
+    BLOCK_SIZE = 100 * 1024
+
+    def expected(self, data):
+        blocks = [hashlib.md5(data[i:i + self.BLOCK_SIZE]).hexdigest()
+                  for i in range(0, len(data), self.BLOCK_SIZE)]
+        whole = hashlib.md5(data).hexdigest()
+        return whole, blocks or [whole]
+
+    def check(self, make_value):
+        pool = WorkerPool(2)
+        try:
+            for size in (0, 1, 3 * self.BLOCK_SIZE, 3 * self.BLOCK_SIZE + 123):
+                data = os.urandom(size)
+                for p in (None, pool):
+                    value = make_value(data)
+                    try:
+                        self.assertEqual(
+                            make_multipart_md5(value, self.BLOCK_SIZE, p),
+                            self.expected(data))
+                    finally:
+                        value.close()
+        finally:
+            pool.close(wait=True)
+
+    def test_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        def make_value(data):
+            with open(path, 'wb') as f:
+                f.write(data)
+            return open(path, 'rb')
+        try:
+            self.check(make_value)
+        finally:
+            os.remove(path)
+
+    def test_bytesio(self):
+        self.check(io.BytesIO)
+
+    def test_stream(self):
+        # - neither mappable nor a buffer, read block by block
+        self.check(lambda data: io.BufferedReader(io.BytesIO(data)))
+
+
+class TestContentMd5(unittest.TestCase):
+    def test_rewind(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'abcdefghijklmn\n')
+        os.close(fd)
+        # - old enough for its digest to be cached
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        cache = upyun.HashCache(path + '.sqlite')
+        expected = hashlib.md5(b'abcdefghijklmn\n').hexdigest()
+        try:
+            with open(path, 'rb') as f:
+                for _ in range(2):
+                    f.seek(5)
+                    self.assertEqual(make_content_md5(f, cache=cache),
+                                     expected)
+                    self.assertEqual(f.tell(), 0)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+        finally:
+            cache.close()
+            os.remove(path)
+            os.remove(path + '.sqlite')
+
+
+class TestDebugLogger(unittest.TestCase):
+    def new_threads(self, before):
+        return [t for t in threading.enumerate()
+                if t.name == 'upyun-debug-logger' and t not in before]
+
+    def test_close(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            logger = upyun.DebugLogger(path)
+            logger.log('init', bucket=BUCKET, password=PASSWORD)
+            logger.close()
+            self.assertTrue(logger.sink.closed)
+            with open(path) as f:
+                record = json.loads(f.read())
+            self.assertEqual((record['event'], record['password']),
+                             ('init', '******'))
+        finally:
+            os.remove(path)
+
+    def test_truthy_debug(self):
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        try:
+            for debug in (True, 1, 'yes'):
+                up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, debug=debug)
+                self.assertIsInstance(up.debug, upyun.DebugLogger)
+                up.debug.close()
+            logger = upyun.DebugLogger([].append)
+            up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, debug=logger)
+            self.assertIs(up.debug, logger)
+            logger.close()
+        finally:
+            os.chdir(cwd)
+            os.remove(os.path.join(tmp, 'debug.log'))
+            os.rmdir(tmp)
+
+    def test_collected(self):
+        records = []
+        before = set(threading.enumerate())
+        logger = upyun.DebugLogger(records.append)
+        logger.log('init', bucket=BUCKET)
+        threads = self.new_threads(before)
+        self.assertEqual(len(threads), 1)
+        # - dropping the last reference stops the writer thread
+        del logger
+        gc.collect()
+        threads[0].join(5)
+        self.assertFalse(threads[0].is_alive())
+        self.assertEqual([r['event'] for r in records], ['init'])
+
+
+class TestPurgeBatcher(unittest.TestCase):
+    def purge(self, keys, domain):
+        self.sent.append(list(keys))
+        return [k for k in keys if 'invalid' in k]
+
+    def setUp(self):
+        self.sent = []
+
+    def test_close_sends_pending(self):
+        batcher = upyun.PurgeBatcher(self.purge, max_delay=60)
+        ticket = batcher.submit(['/a', '/invalid', '/a'])
+        batcher.close()
+        self.assertEqual(ticket.result(0), ['/invalid'])
+        self.assertEqual(self.sent, [['/a', '/invalid']])
+
+    def test_collected(self):
+        batcher = upyun.PurgeBatcher(self.purge, max_delay=0.01)
+        ref = weakref.ref(batcher)
+        self.assertEqual(batcher.submit('/a').result(5), [])
+        # - the idle batcher is kept by neither a thread nor atexit
+        del batcher
+        for _ in range(50):
+            gc.collect()
+            if ref() is None:
+                break
+            time.sleep(0.1)
+        self.assertIsNone(ref())
+        self.assertEqual(self.sent, [['/a']])
+        # - a new thread is started once keys are pending again
+        batcher = upyun.PurgeBatcher(self.purge, max_delay=0.01)
+        batcher.submit('/b').result(5)
+        time.sleep(0.1)
+        self.assertEqual(batcher.submit('/c').result(5), [])
+        batcher.close()
+        self.assertEqual(self.sent, [['/a'], ['/b'], ['/c']])
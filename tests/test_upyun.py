@@ -2,8 +2,11 @@
 import io
 import os
 import sys
+import time
+import shutil
 import uuid
 import json
+from multiprocessing.dummy import Pool as ThreadPool
 
 if sys.version_info >= (2, 7):
     import unittest
@@ -58,6 +61,88 @@ class TestUpYun(unittest.TestCase):
         up.getinfo('/')
         os.remove('debug.log')
 
+    def test_debug_logger(self):
+        records = []
+        logger = upyun.DebugLogger(sink=records.append)
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, SECRET,
+                         endpoint=upyun.ED_AUTO, debug=logger)
+        up.getinfo('/')
+        logger.flush()
+        self.assertEqual(records[0]['event'], 'init')
+        self.assertEqual(records[0]['password'], '******')
+        self.assertEqual(records[1]['event'], 'http')
+        self.assertEqual(records[1]['method'], 'HEAD')
+        self.assertEqual(records[1]['status'], 200)
+        self.assertEqual(records[1]['headers']['Authorization'], '******')
+        logger.close()
+
+    def test_retry_policy(self):
+        policy = upyun.RetryPolicy(total=2, backoff_factor=0.01)
+        up = upyun.UpYun('bucket', 'username', 'password', retry=policy)
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            up.getinfo('/')
+        self.assertEqual(se.exception.status, 401)
+        self.assertEqual(policy.retries, 0)
+
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, retry=policy,
+                         endpoint='127.0.0.1:1')
+        with self.assertRaises(upyun.UpYunClientException):
+            up.getinfo('/')
+        self.assertEqual(policy.retries, 2)
+
+    def test_smart_endpoint(self):
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         endpoint=upyun.ED_SMART)
+        res = up.getinfo('/')
+        self.assertDictEqual(res, {'file-type': 'folder'})
+        # - the other probes end within probe_timeout
+        time.sleep(up.selector.probe_timeout)
+        scores = up.endpoint_scores()
+        self.assertEqual(sorted(scores), sorted(upyun.ED_SMART_HOSTS))
+        self.assertEqual(sum(s['requests'] for s in scores.values()),
+                         len(upyun.ED_SMART_HOSTS) + 1)
+
+        selector = upyun.EndpointSelector(['127.0.0.1:1', upyun.ED_AUTO])
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         endpoint=selector)
+        self.assertEqual(up.endpoint_scores()['127.0.0.1:1']['requests'], 0)
+        for _ in range(3):
+            self.assertDictEqual(up.getinfo('/'), {'file-type': 'folder'})
+        self.assertEqual(selector.best(), upyun.ED_AUTO)
+        self.assertGreater(selector.scores()['127.0.0.1:1']['failures'], 0)
+
+    def test_connection_pool(self):
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         endpoint=upyun.ED_AUTO, pool_maxsize=4,
+                         pool_block=True, keepalive=30)
+        self.assertIs(up.hp.session.get_adapter('http://'), up.hp.adapter)
+        self.assertEqual(up.hp.adapter._pool_maxsize, 4)
+        self.assertTrue(up.hp.adapter._pool_block)
+        pool = ThreadPool(16)
+        res = pool.map(lambda _: up.getinfo('/'), range(32))
+        pool.close()
+        pool.join()
+        for r in res:
+            self.assertDictEqual(r, {'file-type': 'folder'})
+
+    def test_bulk(self):
+        keys = [self.root + 'bulk/%d.txt' % i for i in range(20)]
+        res = list(self.up.put_many(((k, b(k)) for k in keys),
+                                    concurrency=4, window=4))
+        self.assertEqual(sorted(r.key for r in res), sorted(keys))
+        for r in res:
+            self.assertIsNone(r.error)
+        for r in self.up.get_many(keys, concurrency=4):
+            self.assertEqual(r.result, r.key)
+        for r in self.up.getinfo_many(keys + [self.root + 'bulk/none']):
+            if r.key in keys:
+                self.assertEqual(r.result['file-size'], str(len(r.key)))
+            else:
+                self.assertEqual(r.error.status, 404)
+        for r in self.up.delete_many(keys):
+            self.assertIsNone(r.error)
+        self.up.delete(self.root + 'bulk')
+
     def test_auth_failed(self):
         with self.assertRaises(upyun.UpYunServiceException) as se:
             upyun.UpYun('bucket', 'username', 'password').getinfo('/')
@@ -140,6 +225,78 @@ class TestUpYun(unittest.TestCase):
             self.up.getinfo(self.root + 'test.png')
         self.assertEqual(se.exception.status, 404)
 
+    def test_put_large_file(self):
+        with open('tests/bigfile.bin', 'wb') as f:
+            f.write(os.urandom(8 * 1024 * 1024 + 7))
+        with open('tests/bigfile.bin', 'rb') as f:
+            before = upyun.make_content_md5(f)
+            self.assertEqual(f.tell(), 0)
+            self.up.put(self.root + 'bigfile.bin', f, checksum=True)
+        res = self.up.getinfo(self.root + 'bigfile.bin')
+        self.assertEqual(res['file-size'], str(8 * 1024 * 1024 + 7))
+        with open('tests/get.bin', 'wb') as f:
+            self.up.get(self.root + 'bigfile.bin', f)
+        with open('tests/get.bin', 'rb') as f:
+            self.assertEqual(upyun.make_content_md5(f), before)
+        os.remove('tests/bigfile.bin')
+        os.remove('tests/get.bin')
+        self.up.delete(self.root + 'bigfile.bin')
+
+    def test_get_parallel(self):
+        class ProgressBarHandler(object):
+            def __init__(self, totalsize, params):
+                params.assertEqual(totalsize, 3 * 1024 * 1024 + 7)
+                self.params = params
+                self.totalsize = totalsize
+                self.finished = False
+
+            def update(self, readsofar):
+                self.params.assertLess(readsofar, self.totalsize)
+
+            def finish(self):
+                self.finished = True
+
+        with open('tests/bigfile.bin', 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 7))
+        with open('tests/bigfile.bin', 'rb') as f:
+            before = upyun.make_content_md5(f)
+            self.up.put(self.root + 'bigfile.bin', f)
+        with open('tests/get.bin', 'wb') as f:
+            self.up.get(self.root + 'bigfile.bin', f, parallel=4,
+                        part_size=1024 * 1024, handler=ProgressBarHandler,
+                        params=self)
+            self.assertEqual(f.tell(), 3 * 1024 * 1024 + 7)
+        with open('tests/get.bin', 'rb') as f:
+            self.assertEqual(upyun.make_content_md5(f), before)
+        os.remove('tests/bigfile.bin')
+        os.remove('tests/get.bin')
+        self.up.delete(self.root + 'bigfile.bin')
+
+    def test_get_resume(self):
+        with open('tests/bigfile.bin', 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 7))
+        with open('tests/bigfile.bin', 'rb') as f:
+            before = upyun.make_content_md5(f)
+            self.up.put(self.root + 'bigfile.bin', f)
+        info = self.up.getinfo(self.root + 'bigfile.bin')
+        # - pretend a previous run stopped after the first megabyte
+        with open('tests/bigfile.bin', 'rb') as src:
+            with open('tests/get.bin', 'wb') as f:
+                f.write(src.read(1024 * 1024))
+        with open('tests/get.bin.upyun-ckpt', 'w') as f:
+            json.dump({'key': self.root + 'bigfile.bin',
+                       'validator': [info['file-size'], info['file-date'],
+                                     None, None],
+                       'done': [[0, 1024 * 1024 - 1]]}, f)
+        self.up.get(self.root + 'bigfile.bin', 'tests/get.bin', resume=True,
+                    parallel=2, part_size=1024 * 1024)
+        self.assertFalse(os.path.exists('tests/get.bin.upyun-ckpt'))
+        with open('tests/get.bin', 'rb') as f:
+            self.assertEqual(upyun.make_content_md5(f), before)
+        os.remove('tests/bigfile.bin')
+        os.remove('tests/get.bin')
+        self.up.delete(self.root + 'bigfile.bin')
+
     def test_mkdir(self):
         self.up.mkdir(self.root + 'test')
         res = self.up.getinfo(self.root + 'test')
@@ -171,6 +328,118 @@ class TestUpYun(unittest.TestCase):
             self.up.getlist(self.root + 'test')
         self.assertEqual(se.exception.status, 404)
 
+    def test_getlist_compact(self):
+        self.up.mkdir(self.root + 'test')
+        with open('tests/test.png', 'rb') as f:
+            self.up.put(self.root + 'test.png', f, checksum=False)
+        res = self.up.getlist(self.root, compact=True)
+        self.assertIsInstance(res, upyun.ListResult)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res.total_size(), 13001)
+        self.assertEqual(res.folders().names, ['test'])
+        self.assertEqual(res.files()[0].size, 13001)
+        self.assertEqual(res.filter(suffix='.png', min_size=1).names,
+                         ['test.png'])
+        self.assertEqual(res.sort('size', reverse=True).names,
+                         ['test.png', 'test'])
+        self.assertEqual(sorted(res.to_dicts(), key=lambda d: d['name']),
+                         sorted(self.up.getlist(self.root),
+                                key=lambda d: d['name']))
+        self.up.delete(self.root + 'test')
+        self.up.delete(self.root + 'test.png')
+
+    def test_iterlist(self):
+        for i in range(5):
+            self.up.put(self.root + 'list/%d.txt' % i, 'x' * i)
+        res = list(self.up.iterlist(self.root + 'list', limit=2))
+        self.assertEqual(sorted(r['name'] for r in res),
+                         ['%d.txt' % i for i in range(5)])
+        it = self.up.iterlist(self.root + 'list/', limit=2)
+        self.assertEqual(next(it)['type'], 'N')
+        it.close()
+        for i in range(5):
+            self.up.delete(self.root + 'list/%d.txt' % i)
+        self.assertEqual(list(self.up.iterlist(self.root + 'list')), [])
+        self.up.delete(self.root + 'list')
+
+    def test_walk(self):
+        keys = ['walk/a.txt', 'walk/sub/b.txt', 'walk/sub/deep/c.txt']
+        for k in keys:
+            self.up.put(self.root + k, 'abc')
+        res = dict((p, (ds, fs))
+                   for p, ds, fs in self.up.walk(self.root + 'walk',
+                                                 concurrency=4))
+        self.assertEqual(sorted(res), [self.root + 'walk/',
+                                       self.root + 'walk/sub/',
+                                       self.root + 'walk/sub/deep/'])
+        self.assertEqual([f['name'] for f in
+                          res[self.root + 'walk/sub/deep/'][1]], ['c.txt'])
+        self.assertEqual(len(list(self.up.walk(self.root + 'walk',
+                                               maxdepth=1))), 2)
+        res = [p for p, _, _ in self.up.walk(
+            self.root + 'walk', predicate=self.root + 'walk/sub/deep')]
+        self.assertIn(self.root + 'walk/sub/deep/', res)
+        for k in reversed(keys):
+            self.up.delete(self.root + k)
+        for d in ('walk/sub/deep', 'walk/sub', 'walk'):
+            self.up.delete(self.root + d)
+        with self.assertRaises(upyun.UpYunServiceException) as se:
+            list(self.up.walk(self.root + 'walk'))
+        self.assertEqual(se.exception.status, 404)
+        errors = []
+        self.assertEqual(list(self.up.walk(self.root + 'walk',
+                                           onerror=errors.append)), [])
+        self.assertEqual([e.status for e in errors], [404])
+
+    def test_cache(self):
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         cache=upyun.MetaCache(maxsize=10, ttl=60))
+        key = self.root + 'cache/a.txt'
+        up.put(key, 'abc')
+        self.assertEqual(up.getinfo(key)['file-size'], '3')
+        self.assertEqual(up.getinfo(key)['file-size'], '3')
+        self.assertEqual(len(up.getlist(self.root + 'cache')), 1)
+        stats = up.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        up.put(key, 'abcdef')
+        self.assertEqual(up.getinfo(key)['file-size'], '6')
+        self.assertEqual(up.getlist(self.root + 'cache')[0]['size'], '6')
+        up.delete(key)
+        self.assertRaises(upyun.UpYunServiceException, up.getinfo, key)
+        self.assertEqual(up.getlist(self.root + 'cache'), [])
+        up.delete(self.root + 'cache')
+        self.assertEqual(self.up.cache_stats(), {})
+
+    def test_sync(self):
+        local = 'tests/sync'
+        os.makedirs(os.path.join(local, 'sub'))
+        for name in ('a.txt', 'sub/b.txt'):
+            with open(os.path.join(local, name), 'wb') as f:
+                f.write(b'abc')
+        remote = self.root + 'sync/'
+        try:
+            res = self.up.sync(local, remote, dry_run=True)
+            self.assertEqual(res.upload, [remote + 'a.txt',
+                                          remote + 'sub/b.txt'])
+            self.assertRaises(upyun.UpYunServiceException,
+                              self.up.getinfo, remote + 'a.txt')
+            res = self.up.sync(local, remote, concurrency=2)
+            self.assertEqual(res.errors, [])
+            self.assertEqual(self.up.get(remote + 'sub/b.txt'), 'abc')
+            res = self.up.sync(local, remote, checksum=True)
+            self.assertEqual(res.upload, [])
+            self.assertEqual(len(res.unchanged), 2)
+            shutil.rmtree(os.path.join(local, 'sub'))
+            res = self.up.sync(local, remote, delete=True)
+            self.assertEqual(res.delete, [remote + 'sub/b.txt',
+                                          remote + 'sub'])
+            self.assertEqual([f['name'] for f in self.up.getlist(remote)],
+                             ['a.txt'])
+        finally:
+            shutil.rmtree(local)
+            self.up.delete(remote + 'a.txt')
+            self.up.delete(remote)
+
     def test_delete(self):
         with open('tests/test.png', 'rb') as f:
             self.up.put(self.root + 'test/test.png', f, checksum=False)
@@ -196,6 +465,20 @@ class TestUpYun(unittest.TestCase):
             self.up.getinfo(self.root + 'test.png')
         self.assertEqual(se.exception.status, 404)
 
+    def test_chunksize_auto(self):
+        sizing = upyun.ChunkSizing(upload=256 * 1024, download=512 * 1024)
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         chunksize=sizing)
+        self.assertEqual(up.chunksize, 8192)
+        data = os.urandom(3 * 1024 * 1024)
+        res = up.put(self.root + 'chunks.bin', io.BytesIO(data),
+                     checksum=True)
+        self.assertDictEqual(res, {})
+        f = io.BytesIO()
+        up.get(self.root + 'chunks.bin', f)
+        self.assertEqual(f.getvalue(), data)
+        up.delete(self.root + 'chunks.bin')
+
     def test_handler_progressbar(self):
         class ProgressBarHandler(object):
             def __init__(self, totalsize, params):
@@ -211,14 +494,17 @@ class TestUpYun(unittest.TestCase):
             def finish(self):
                 self.params.assertEqual(self.readtimes, 3)
 
-        self.up.up_rest.chunksize = 4096
+        # - unthrottled, every chunk is reported
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         progress_interval=None)
+        up.up_rest.chunksize = 4096
 
         with open('tests/test.png', 'rb') as f:
-            self.up.put(self.root + 'test.png', f, handler=ProgressBarHandler,
-                        params=self)
+            up.put(self.root + 'test.png', f, handler=ProgressBarHandler,
+                   params=self)
         with open('tests/get.png', 'wb') as f:
-            self.up.get(self.root + 'test.png', f, handler=ProgressBarHandler,
-                        params=self)
+            up.get(self.root + 'test.png', f, handler=ProgressBarHandler,
+                   params=self)
 
         self.up.delete(self.root + 'test.png')
         with self.assertRaises(upyun.UpYunServiceException) as se:
@@ -233,6 +519,70 @@ class TestUpYun(unittest.TestCase):
         res = self.up.purge('/test.png', 'invalid.upyun.com')
         self.assertListEqual(res, [u'/test.png'])
 
+    def test_hash_cache(self):
+        cache = upyun.HashCache('tests/hashes.sqlite')
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, timeout=100,
+                         hash_cache=cache)
+        with open('tests/hash.bin', 'wb') as f:
+            f.write(b'x' * 1024 * 1024)
+        past = time.time() - 60
+        os.utime('tests/hash.bin', (past, past))
+        try:
+            with open('tests/hash.bin', 'rb') as f:
+                up.put(self.root + 'hash.bin', f, checksum=True)
+                up.put(self.root + 'hash.bin', f, checksum=True)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            res = up.getinfo(self.root + 'hash.bin')
+            self.assertEqual(res['file-size'], str(1024 * 1024))
+        finally:
+            cache.close()
+            os.remove('tests/hash.bin')
+            os.remove('tests/hashes.sqlite')
+            up.delete(self.root + 'hash.bin')
+
+    def test_purge_batcher(self):
+        with self.up.purge_batcher(max_delay=0.5, max_urls=2) as batcher:
+            t1 = batcher.submit(['/test.png', 'test/test.png', '/test.png'])
+            t2 = batcher.submit('/test.png', 'invalid.upyun.com')
+            t3 = batcher.submit(['/a.png', '/b.png', '/c.png'])
+        self.assertListEqual(t1.result(), [])
+        self.assertListEqual(t2.result(), [u'/test.png'])
+        self.assertListEqual(t3.result(), [])
+        self.assertEqual(batcher.urls, 6)
+        self.assertRaises(upyun.UpYunClientException, batcher.submit, '/a')
+
+    def test_progress_monitor(self):
+        class Handler(object):
+            def __init__(self, totalsize, params):
+                self.params = params
+                self.params.updates = 0
+
+            def update(self, readsofar):
+                self.params.updates += 1
+
+            def finish(self):
+                self.params.finished = True
+
+        monitor = upyun.TransferMonitor()
+        up = upyun.UpYun(BUCKET, USERNAME, PASSWORD, SECRET, timeout=100,
+                         monitor=monitor, progress_interval=None,
+                         progress_step=1024 * 1024)
+        with open('tests/bigfile.bin', 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024))
+        with open('tests/bigfile.bin', 'rb') as f:
+            up.put(self.root + 'bigfile.bin', f, multipart=True,
+                   block_size=1024 * 1024, handler=Handler, params=self)
+        self.assertEqual(self.updates, 2)
+        self.assertTrue(self.finished)
+        with open('tests/get.bin', 'wb') as f:
+            up.get(self.root + 'bigfile.bin', f, parallel=3)
+        res = monitor.snapshot()
+        self.assertEqual((res['transfers'], res['active']), (2, 0))
+        self.assertEqual(res['bytes'], 6 * 1024 * 1024)
+        os.remove('tests/bigfile.bin')
+        os.remove('tests/get.bin')
+        up.delete(self.root + 'bigfile.bin')
+
     def test_filelike_object_flask(self):
         class ProgressBarHandler(object):
             def __init__(self, totalsize, params):
@@ -338,9 +688,60 @@ class TestUpYun(unittest.TestCase):
         up.up_multi.password = None
         __put(self.up)
         __put(self.up, kwargs=kwargs)
+        __put(self.up, kwargs={'concurrency': 8})
+        __put(self.up, kwargs={'concurrency': 'auto'})
         __put(up)
         os.remove('tests/bigfile.txt')
 
+    @unittest.skipUnless(SECRET, 'you have to specify bucket secret')
+    def test_put_multipart_bytesio(self):
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        res = self.up.put(self.root + 'test_bytesio.bin', io.BytesIO(data),
+                          multipart=True, block_size=1024*1024)
+        self.assertEqual(res['path'], self.root + 'test_bytesio.bin')
+        res = self.up.getinfo(self.root + 'test_bytesio.bin')
+        self.assertEqual(res['file-size'], str(len(data)))
+        self.up.delete(self.root + 'test_bytesio.bin')
+
+    @unittest.skipUnless(SECRET, 'you have to specify bucket secret')
+    def test_put_multipart_stream(self):
+        data = os.urandom(3 * 1024 * 1024 + 7)
+
+        def stream():
+            for i in range(0, len(data), 65536):
+                yield data[i:i + 65536]
+        res = self.up.put(self.root + 'test_stream.bin', stream(),
+                          multipart=True, block_size=1024*1024,
+                          file_size=len(data),
+                          file_hash=upyun.make_content_md5(data))
+        self.assertEqual(res['path'], self.root + 'test_stream.bin')
+        res = self.up.getinfo(self.root + 'test_stream.bin')
+        self.assertEqual(res['file-size'], str(len(data)))
+        with self.assertRaises(upyun.UpYunClientException):
+            self.up.put(self.root + 'test_stream.bin', stream(),
+                        multipart=True, file_size=len(data) + 1,
+                        file_hash=upyun.make_content_md5(data))
+        self.up.delete(self.root + 'test_stream.bin')
+
+    @unittest.skipUnless(SECRET, 'you have to specify bucket secret')
+    def test_put_multipart_journal(self):
+        with open('tests/bigfile.bin', 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 7))
+        with open('tests/bigfile.bin', 'rb') as f:
+            res = self.up.put(self.root + 'test_journal.bin', f,
+                              multipart=True, block_size=1024*1024,
+                              journal='tests/journal')
+        self.assertEqual(res['path'], self.root + 'test_journal.bin')
+        self.assertEqual(os.listdir('tests/journal'), [])
+        timings = self.up.up_multi.stage_timings
+        for stage in ('read', 'sign', 'upload', 'total'):
+            self.assertEqual(timings[stage]['items'], 4)
+        res = self.up.getinfo(self.root + 'test_journal.bin')
+        self.assertEqual(res['file-size'], str(3 * 1024 * 1024 + 7))
+        self.up.delete(self.root + 'test_journal.bin')
+        os.rmdir('tests/journal')
+        os.remove('tests/bigfile.bin')
+
     def test_pretreat(self):
         with open('/tmp/test.mp4', 'rb') as f:
             res = self.up.put(self.root + 'test.mp4', f, checksum=False)
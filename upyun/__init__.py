@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
+import sys
 
 from .modules.sign import make_content_md5
 from .modules.exception import UpYunServiceException, UpYunClientException
+from .modules.tracer import DebugLogger
+from .modules.retry import RetryPolicy, RetryBudget
+from .modules.endpoint import EndpointSelector, ED_SMART
+from .modules.cache import MetaCache
+from .modules.hashcache import HashCache
+from .modules.progress import TransferMonitor
+from .modules.fileio import ChunkSizing
+from .modules.purge import PurgeBatcher
+from .rest import ListResult
 from .upyun import UpYun, ED_AUTO, ED_TELECOM, ED_CNC, ED_CTT,\
-    __version__, verify_put_sign
+    ED_SMART_HOSTS, BulkResult, SyncReport, __version__, verify_put_sign
+
+if sys.version_info >= (3, 5):
+    from .aio import AsyncUpYun  # noqa: F401
 
 __title__ = 'upyun'
 __author__ = 'Monkey Zhang (timebug)'
@@ -12,6 +25,13 @@ __copyright__ = 'Copyright 2015 UPYUN'
 
 __all__ = [
     'UpYun', 'UpYunServiceException', 'UpYunClientException',
-    'ED_AUTO', 'ED_TELECOM', 'ED_CNC', 'ED_CTT', '__version__',
-    'verify_put_sign', 'make_content_md5'
+    'ED_AUTO', 'ED_TELECOM', 'ED_CNC', 'ED_CTT', 'ED_SMART',
+    'ED_SMART_HOSTS', 'EndpointSelector', '__version__',
+    'verify_put_sign', 'make_content_md5', 'DebugLogger',
+    'RetryPolicy', 'RetryBudget', 'MetaCache', 'HashCache',
+    'TransferMonitor', 'ChunkSizing', 'PurgeBatcher', 'BulkResult',
+    'SyncReport', 'ListResult'
 ]
+
+if sys.version_info >= (3, 5):
+    __all__.append('AsyncUpYun')
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import inspect
+import json
+import os
+
+from .rest import get_fileobj_size, make_uri, make_purge_body,\
+    parse_list, get_meta_headers
+from .form import make_form_params
+from .av import AvPretreatment
+from .upyun import ED_AUTO
+
+from .modules.aiohttpipe import AsyncUpYunHttp, FormData
+from .modules.exception import UpYunClientException, UpYunServiceException
+from .modules.compat import b, str, urlencode
+from .modules.sign import make_rest_signature, make_content_md5,\
+    make_av_signature, decode_msg
+from .modules.httpipe import cur_dt
+from .modules.tracer import DebugLogger
+from .modules.endpoint import EndpointSelector, ED_SMART
+
+DEFAULT_CHUNKSIZE = 8192
+
+
+class AsyncUpYun(object):
+    '''asyncio counterpart of `UpYun`, every API is a coroutine.
+
+    >>> async with AsyncUpYun('bucket', 'username', 'password') as up:
+    >>>     await up.put('/path/to/bar.txt', 'abc')
+    '''
+    def __init__(self, bucket, username=None, password=None, secret=None,
+                 timeout=None, endpoint=None, chunksize=None,
+                 read_timeout=None, pool_maxsize=None, keepalive=None,
+                 debug=False, retry=None):
+        self.bucket = bucket or os.getenv('UPYUN_BUCKET')
+        self.username = username or os.getenv('UPYUN_USERNAME')
+        password = password or os.getenv('UPYUN_PASSWORD')
+        self.password = (hashlib.md5(b(password)).hexdigest()
+                         if password else None)
+        self.endpoint = endpoint or ED_AUTO
+        if (self.endpoint == ED_SMART or
+                isinstance(self.endpoint, EndpointSelector)):
+            raise UpYunClientException('AsyncUpYun does not support '
+                                       'ED_SMART endpoint selection')
+        self.chunksize = chunksize or DEFAULT_CHUNKSIZE
+        self.secret = secret or os.getenv('UPYUN_SECRET')
+        self.timeout = timeout or 60
+        if read_timeout is not None:
+            self.requests_timeout = (self.timeout, read_timeout)
+        else:
+            self.requests_timeout = self.timeout
+        # - any other true value (e.g. debug=1) asks for the default logger
+        if debug and not hasattr(debug, 'log'):
+            debug = DebugLogger()
+        self.debug = debug or None
+        self.hp = AsyncUpYunHttp(self.requests_timeout,
+                                 pool_maxsize=pool_maxsize,
+                                 keepalive=keepalive, debug=self.debug,
+                                 retry=retry)
+
+        if self.username and self.password:
+            self.up_rest = AsyncUpYunRest(self.bucket, self.username,
+                                          self.password, self.endpoint,
+                                          self.chunksize, self.hp)
+            self.av = AsyncAvPretreatment(self.bucket, self.username,
+                                          self.password, self.chunksize,
+                                          self.hp)
+        if self.secret:
+            self.up_form = AsyncFormUpload(self.bucket, self.secret,
+                                           self.endpoint, self.hp)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.hp.close()
+
+    def __check(self, obj_name):
+        if not hasattr(self, obj_name):
+            msg = 'Class AsyncUpYun dont have an attr called %s' % obj_name
+            raise UpYunClientException(msg)
+        return getattr(self, obj_name)
+
+    # --- public rest API
+    async def usage(self, key='/'):
+        return await self.__check('up_rest').usage(key)
+
+    async def put(self, key, value, checksum=False, headers=None,
+                  secret=None, form=False, expiration=None,
+                  multipart=False, **kwargs):
+        if multipart:
+            raise UpYunClientException('AsyncUpYun does not support '
+                                       'multipart upload, use form=True or '
+                                       'the rest API instead')
+        if form and not self.secret:
+            raise UpYunClientException('You have to specify form secret with '
+                                       'form upload method')
+        if form and hasattr(value, 'fileno'):
+            return await self.up_form.upload(key, value, expiration, **kwargs)
+        return await self.__check('up_rest').put(key, value, checksum,
+                                                 headers, secret)
+
+    async def get(self, key, value=None):
+        return await self.__check('up_rest').get(key, value)
+
+    async def delete(self, key):
+        await self.__check('up_rest').delete(key)
+
+    async def mkdir(self, key):
+        await self.__check('up_rest').mkdir(key)
+
+    async def getlist(self, key='/'):
+        return await self.__check('up_rest').getlist(key)
+
+    async def getinfo(self, key):
+        return await self.__check('up_rest').getinfo(key)
+
+    async def purge(self, keys, domain=None):
+        return await self.__check('up_rest').purge(keys, domain)
+
+    # --- video pretreatment API
+    async def pretreat(self, tasks, source, notify_url=''):
+        return await self.__check('av').pretreat(tasks, source, notify_url)
+
+    async def status(self, taskids):
+        return await self.__check('av').status(taskids)
+
+
+class AsyncUpYunRest(object):
+    def __init__(self, bucket, username, password,
+                 endpoint, chunksize, hp):
+        self.bucket = bucket
+        self.username = username
+        self.password = password
+        self.chunksize = chunksize
+        self.endpoint = endpoint
+        self.hp = hp
+
+    # --- public API
+    async def usage(self, key):
+        res = await self.__do_http_request('GET', key, args='?usage')
+        return str(int(res))
+
+    async def put(self, key, value, checksum, headers, secret):
+        if headers is None:
+            headers = {}
+
+        if isinstance(value, str):
+            value = b(value)
+
+        if checksum is True:
+            headers['Content-MD5'] = make_content_md5(value, self.chunksize)
+
+        if secret:
+            headers['Content-Secret'] = secret
+
+        h = await self.__do_http_request('PUT', key, value, headers)
+        return get_meta_headers(h)
+
+    async def get(self, key, value):
+        '''
+        >>> with open('bar.png', 'wb') as f:
+        >>>    await up.get('/path/to/bar.png', f)
+        '''
+        return await self.__do_http_request('GET', key, of=value)
+
+    async def delete(self, key):
+        await self.__do_http_request('DELETE', key)
+
+    async def mkdir(self, key):
+        headers = {'Folder': 'true'}
+        await self.__do_http_request('POST', key, headers=headers)
+
+    async def getlist(self, key):
+        content = await self.__do_http_request('GET', key)
+        return parse_list(content)
+
+    async def getinfo(self, key):
+        h = await self.__do_http_request('HEAD', key)
+        return get_meta_headers(h)
+
+    async def purge(self, keys, domain):
+        domain = domain or '%s.b0.upaiyun.com' % (self.bucket)
+        urlstr = make_purge_body(keys, domain)
+
+        uri = '/purge/'
+        params = urlencode({'purge': urlstr})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Accept': 'application/json'}
+        headers['Date'] = cur_dt()
+        headers['Authorization'] = make_rest_signature(
+            self.bucket, self.username, self.password, None, urlstr,
+            headers['Date'], 0)
+
+        resp = await self.hp.do_http_pipe('POST', 'purge.upyun.com', uri,
+                                          value=params, headers=headers)
+        content = await self.__handle_json(resp)
+        invalid_urls = content['invalid_domain_of_url']
+        return [k[7 + len(domain):] for k in invalid_urls if k]
+
+    # --- private API
+    async def __do_http_request(self, method, key, value=None,
+                                headers=None, of=None, args=''):
+        uri = make_uri(self.bucket, key, args)
+
+        if headers is None:
+            headers = {}
+
+        length = 0
+        if hasattr(value, '__len__'):
+            length = len(value)
+            headers['Content-Length'] = length
+        elif hasattr(value, 'fileno'):
+            length = get_fileobj_size(value)
+            headers['Content-Length'] = length
+            if not length:
+                value = b''
+        elif value is not None:
+            raise UpYunClientException('object type error')
+
+        headers['Date'] = cur_dt()
+        headers['Authorization'] = make_rest_signature(
+            self.bucket, self.username, self.password, method, uri,
+            headers['Date'], length)
+
+        resp = await self.hp.do_http_pipe(method, self.endpoint, uri,
+                                          value, headers)
+        try:
+            if method == 'GET' and of:
+                async for chunk in resp.content.iter_chunked(self.chunksize):
+                    res = of.write(chunk)
+                    if inspect.isawaitable(res):
+                        await res
+            elif method == 'GET':
+                return await resp.text(encoding='utf-8')
+            elif method == 'PUT' or method == 'HEAD':
+                return resp.headers.items()
+        except UpYunClientException:
+            raise
+        except Exception as e:
+            raise UpYunClientException(e)
+        finally:
+            resp.release()
+
+    async def __handle_json(self, resp):
+        try:
+            return await resp.json(content_type=None)
+        except Exception as e:
+            raise UpYunClientException(e)
+        finally:
+            resp.release()
+
+
+class AsyncFormUpload(object):
+    def __init__(self, bucket, secret, endpoint, hp):
+        self.bucket = bucket
+        self.secret = secret
+        self.hp = hp
+        self.host = endpoint
+        self.uri = '/%s/' % bucket
+
+    async def upload(self, key, value, expiration, **kwargs):
+        policy, signature = make_form_params(self.bucket, self.secret, key,
+                                             expiration, **kwargs)
+        postdata = FormData()
+        postdata.add_field('policy', decode_msg(policy))
+        postdata.add_field('signature', signature)
+        postdata.add_field('file', value,
+                           filename=os.path.basename(value.name))
+        resp = await self.hp.do_http_pipe('POST', self.host, self.uri,
+                                          data=postdata)
+        try:
+            return await resp.json(content_type=None)
+        except Exception as e:
+            raise UpYunClientException(e)
+        finally:
+            resp.release()
+
+
+class AsyncAvPretreatment(object):
+    HOST = AvPretreatment.HOST
+    PRETREAT = AvPretreatment.PRETREAT
+    STATUS = AvPretreatment.STATUS
+
+    def __init__(self, bucket, operator, password,
+                 chunksize, hp):
+        self.bucket = bucket
+        self.operator = operator
+        self.password = password
+        self.chunksize = chunksize
+        self.hp = hp
+
+    # --- public API
+    async def pretreat(self, tasks, source, notify_url, app_name=None):
+        assert isinstance(tasks, list)
+        data = {'bucket_name': self.bucket, 'source': source,
+                'notify_url': notify_url,
+                'tasks': decode_msg(base64.b64encode(b(json.dumps(tasks)))),
+                }
+        if app_name:
+            data['app_name'] = app_name
+        headers = {'Authorization': self.__make_auth(data),
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+        resp = await self.hp.do_http_pipe('POST', self.HOST, self.PRETREAT,
+                                          headers=headers,
+                                          value=urlencode(data))
+        return await self.__handle_resp(resp)
+
+    async def status(self, taskids):
+        if isinstance(taskids, str):
+            taskids = taskids.split(',')
+        if type(taskids) == list and len(taskids) <= 20:
+            taskids = ','.join(taskids)
+        else:
+            raise UpYunClientException('length of taskids should less than 20')
+
+        data = {'bucket_name': self.bucket, 'task_ids': taskids}
+        headers = {'Authorization': self.__make_auth(data)}
+        uri = '%s?%s' % (self.STATUS, urlencode(data))
+        resp = await self.hp.do_http_pipe('GET', self.HOST, uri,
+                                          headers=headers)
+        content = await self.__handle_resp(resp)
+        if type(content) == dict and 'tasks' in content:
+            return content['tasks']
+        raise UpYunServiceException(None, 500,
+                                    'Servers except respond tasks list',
+                                    'Service Error')
+
+    # --- private API
+    def __make_auth(self, data):
+        signature = make_av_signature(data, self.operator, self.password)
+        return 'UPYUN %s:%s' % (self.operator, signature)
+
+    async def __handle_resp(self, resp):
+        try:
+            return await resp.json(content_type=None)
+        except Exception as e:
+            raise UpYunClientException(e)
+        finally:
+            resp.release()
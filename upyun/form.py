@@ -5,34 +5,54 @@ import time
 from .modules.exception import UpYunClientException
 from .modules.sign import make_content_md5, make_policy
 from .modules.compat import b
+from .modules.progress import ProgressReporter
+
+
+def make_form_params(bucket, secret, key, expiration, **kwargs):
+    expiration = expiration or 1800
+    expiration += int(time.time())
+
+    data = {'bucket': bucket,
+            'expiration': expiration,
+            'save-key': key,
+            }
+    data.update(kwargs)
+    policy = make_policy(data)
+    signature = make_content_md5(policy + b('&') + b(secret))
+    return policy, signature
 
 
 class FormUpload(object):
-    def __init__(self, bucket, secret, endpoint, hp):
+    def __init__(self, bucket, secret, endpoint, hp, progress=None):
         self.bucket = bucket
         self.secret = secret
         self.hp = hp
+        self.progress = progress or ProgressReporter()
         self.host = endpoint
         self.uri = '/%s/' % bucket
 
-    def upload(self, key, value, expiration, **kwargs):
-        expiration = expiration or 1800
-        expiration += int(time.time())
-
-        data = {'bucket': self.bucket,
-                'expiration': expiration,
-                'save-key': key,
-                }
-        data.update(kwargs)
-        policy = make_policy(data)
-        signature = make_content_md5(policy + b('&') + b(self.secret))
+    def upload(self, key, value, expiration, handler=None, params=None,
+               **kwargs):
+        policy, signature = make_form_params(self.bucket, self.secret, key,
+                                             expiration, **kwargs)
         postdata = {'policy': policy,
                     'signature': signature,
                     'file': (os.path.basename(value.name), value),
                     }
-        resp = self.hp.do_http_pipe('POST', self.host, self.uri,
-                                    files=postdata)
-        return self.__handle_resp(resp)
+        # - the form body is built in memory, progress is only known
+        # - once the request is done
+        progress = self.progress(os.fstat(value.fileno()).st_size,
+                                 handler, params)
+        try:
+            resp = self.hp.do_http_pipe('POST', self.host, self.uri,
+                                        files=postdata)
+            res = self.__handle_resp(resp)
+            if progress is not None:
+                progress.finish()
+            return res
+        finally:
+            if progress is not None:
+                progress.abort()
 
     def __handle_resp(self, resp):
         content = None
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+import upyun
+
+from .exception import UpYunServiceException, UpYunClientException
+from .httpipe import cur_dt
+from .compat import builtin_str, str
+from .retry import RetryPolicy, CONNECT_ERROR, READ_ERROR,\
+    parse_retry_after, mark_body, rewind_body
+
+DEFAULT_POOL_MAXSIZE = 100
+
+try:
+    import aiohttp
+    from aiohttp import FormData
+except ImportError:
+    aiohttp = FormData = None
+
+
+class AsyncUpYunHttp(object):
+    def __init__(self, timeout, pool_maxsize=None, keepalive=None,
+                 debug=None, retry=None):
+        if aiohttp is None:
+            raise UpYunClientException('AsyncUpYun requires aiohttp, '
+                                       'run `pip install aiohttp` first')
+        if isinstance(timeout, tuple):
+            self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                                 sock_read=timeout[1])
+        else:
+            self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_maxsize = pool_maxsize or DEFAULT_POOL_MAXSIZE
+        self.keepalive = keepalive
+        self.debug = debug
+        if retry is None or retry is True:
+            retry = RetryPolicy()
+        self.retry = retry or None
+        self.session = None
+        self.user_agent = None
+
+    async def do_http_pipe(self, method, host, uri,
+                           value=None, headers=None, data=None):
+        '''Send one request and return the aiohttp response, whose body
+        has not been read yet on success. The caller must release it.
+        '''
+        headers = self.__set_headers(headers)
+        if data is not None:
+            value = data
+        if self.retry is None:
+            return await self.__request(method, host, uri, value, headers)
+
+        self.retry.on_request()
+        marks = mark_body(value)
+        attempt = 0
+        while True:
+            try:
+                return await self.__request(method, host, uri, value,
+                                            headers)
+            except UpYunServiceException as se:
+                retry_after = parse_retry_after(
+                    (se.headers or {}).get('Retry-After'))
+                delay = self.retry.next_delay(method, attempt,
+                                              status=se.status,
+                                              retry_after=retry_after)
+                if delay is None or marks is None:
+                    raise
+            except UpYunClientException as ce:
+                e = ce.args[0]
+                if isinstance(e, aiohttp.ClientConnectorError):
+                    error = CONNECT_ERROR
+                elif isinstance(e, (aiohttp.ClientError,
+                                    asyncio.TimeoutError)):
+                    error = READ_ERROR
+                else:
+                    error = None
+                delay = self.retry.next_delay(method, attempt, error=error)
+                if delay is None or marks is None:
+                    raise
+            if self.debug:
+                self.debug.log('retry', method=method, host=host, uri=uri,
+                               attempt=attempt + 1, delay=delay)
+            rewind_body(marks)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # - https://docs.aiohttp.org/
+    async def __request(self, method, host, uri, value, headers):
+        url = 'http://%s%s' % (host, uri)
+        start = time.time()
+        try:
+            resp = await self.__get_session().request(method, url,
+                                                      data=value,
+                                                      headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.__trace(method, host, uri, headers, start, error=e)
+            raise UpYunClientException(e)
+
+        request_id = resp.headers.get('X-Request-Id', 'Unknown')
+        if resp.status // 100 != 2:
+            try:
+                err = await resp.text(encoding='utf-8')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise UpYunClientException(e)
+            finally:
+                resp.release()
+            self.__trace(method, host, uri, headers, start, resp,
+                         request_id, resp.reason)
+            raise UpYunServiceException(request_id, resp.status,
+                                        resp.reason, err, resp.headers)
+        self.__trace(method, host, uri, headers, start, resp, request_id)
+        return resp
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __trace(self, method, host, uri, headers, start, resp=None,
+                request_id=None, error=None):
+        if not self.debug:
+            return
+        self.debug.log('http', method=method, host=host, uri=uri,
+                       headers=headers,
+                       status=resp.status if resp is not None else None,
+                       request_id=request_id,
+                       request_bytes=int(headers.get('Content-Length', 0)),
+                       response_bytes=(resp.content_length
+                                       if resp is not None else None),
+                       elapsed=time.time() - start,
+                       error=builtin_str(error) if error else None)
+
+    def __get_session(self):
+        # - aiohttp sessions must be created inside the running loop
+        if self.session is None or self.session.closed:
+            kwargs = {'limit': 0, 'limit_per_host': self.pool_maxsize}
+            if self.keepalive is not None:
+                kwargs['keepalive_timeout'] = self.keepalive
+            connector = aiohttp.TCPConnector(**kwargs)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=self.timeout)
+        return self.session
+
+    def __make_user_agent(self):
+        return 'upyun-python-sdk/%s aiohttp/%s' % (upyun.__version__,
+                                                   aiohttp.__version__)
+
+    def __set_headers(self, headers):
+        headers = dict((k, v if isinstance(v, (str, builtin_str))
+                        else builtin_str(v))
+                       for k, v in (headers or {}).items())
+        if 'Date' not in headers:
+            headers['Date'] = cur_dt()
+        if 'User-Agent' not in headers:
+            if self.user_agent is None:
+                self.user_agent = self.__make_user_agent()
+            headers['User-Agent'] = self.user_agent
+        return headers
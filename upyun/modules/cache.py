@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 60
+
+
+class MetaCache(object):
+    '''A thread-safe LRU cache of file metadata and directory listings.
+
+    At most `maxsize` entries are kept, the least recently used one is
+    evicted first, and entries older than `ttl` seconds are treated as
+    missing. Keys are `(kind, path)` tuples.
+
+    A value fetched while its key was invalidated is stale: readers take
+    `generation(key)` before fetching and pass it to `set`, which then
+    drops the value if `invalidate` ran in between.
+    '''
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+        # - the generation of the last invalidation of recent keys, older
+        # - ones are forgotten and count as invalidated at `__floor`
+        self.__generation = 0
+        self.__generations = OrderedDict()
+        self.__floor = 0
+
+    def get(self, key):
+        '''Return the cached value of `key`, or None.'''
+        with self.__lock:
+            item = self.__data.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            # - re-insert to mark as most recently used
+            self.__data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def generation(self, key):
+        '''Return the token to pass to `set` for a value of `key` about
+        to be fetched.
+        '''
+        with self.__lock:
+            return self.__generations.get(key, self.__floor)
+
+    def set(self, key, value, generation=None):
+        with self.__lock:
+            if (generation is not None and
+                    self.__generations.get(key, self.__floor) != generation):
+                return
+            self.__data.pop(key, None)
+            self.__data[key] = (time.time() + self.ttl, value)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self.__lock:
+            self.__generation += 1
+            for key in keys:
+                self.__data.pop(key, None)
+                self.__generations.pop(key, None)
+                self.__generations[key] = self.__generation
+            while len(self.__generations) > self.maxsize:
+                self.__floor = self.__generations.popitem(last=False)[1]
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.__generation += 1
+            self.__generations.clear()
+            self.__floor = self.__generation
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self.__data)}
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+
+def save_json(path, data):
+    '''Atomically replace `path` with `data` serialized as JSON.'''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    if hasattr(os, 'replace'):
+        os.replace(tmp, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except EnvironmentError:
+        pass
+
+
+class DownloadCheckpoint(object):
+    '''Sidecar record of the byte ranges of a download already on disk.
+
+    The record is only reused while `key` and `validator` (size, date
+    and ETag of the remote object) are unchanged.
+    '''
+    def __init__(self, path, key, validator):
+        self.path = path
+        self.key = key
+        self.validator = validator
+        self.done = []
+        self.__lock = threading.Lock()
+
+    def load(self):
+        '''Restore completed ranges, return False if the record is
+        missing or belongs to another version of the object.
+        '''
+        data = load_json(self.path)
+        if (not isinstance(data, dict) or data.get('key') != self.key or
+                data.get('validator') != self.validator):
+            self.done = []
+            return False
+        self.done = [tuple(r) for r in data.get('done', [])]
+        return True
+
+    def add(self, start, end):
+        with self.__lock:
+            ranges = sorted(self.done + [(start, end)])
+            merged = [ranges[0]]
+            for s, e in ranges[1:]:
+                if s <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+                else:
+                    merged.append((s, e))
+            self.done = merged
+            save_json(self.path, {'key': self.key,
+                                  'validator': self.validator,
+                                  'done': self.done})
+
+    def completed(self):
+        return sum(e - s + 1 for s, e in self.done)
+
+    def missing(self, size, part_size):
+        '''Return the ranges still to fetch, at most `part_size` long.'''
+        gaps = []
+        position = 0
+        for s, e in self.done + [(size, size)]:
+            if s > position:
+                gaps.append((position, min(s, size) - 1))
+            position = max(position, e + 1)
+        return [(s, min(s + part_size, e + 1) - 1)
+                for gs, e in gaps for s in range(gs, e + 1, part_size)]
+
+    def remove(self):
+        remove_file(self.path)
+
+
+class UploadJournal(object):
+    '''On-disk record of a multipart upload in progress: the tokens of
+    the upload session and the status of every block.
+
+    A record is only returned by `load` while its session has at least
+    `margin` seconds left before expiring.
+    '''
+    def __init__(self, path, margin=300):
+        self.path = path
+        self.margin = margin
+        self.state = None
+
+    def load(self):
+        data = load_json(self.path)
+        if (not isinstance(data, dict) or
+                data.get('expiration', 0) < time.time() + self.margin):
+            self.remove()
+            return None
+        self.state = data
+        return data
+
+    def start(self, **state):
+        self.state = state
+        save_json(self.path, state)
+
+    def update(self, status):
+        self.state['status'] = status
+        save_json(self.path, self.state)
+
+    def remove(self):
+        self.state = None
+        remove_file(self.path)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+ED_SMART = 'smart'
+
+DEFAULT_ALPHA = 0.3
+DEFAULT_ERROR_PENALTY = 10
+DEFAULT_PROBE_INTERVAL = 60
+DEFAULT_PROBE_TIMEOUT = 2
+
+
+class EndpointSelector(object):
+    '''Score a set of API hosts and route requests to the best one.
+
+    Each host keeps an exponentially weighted moving average of its
+    latency and of its error rate, both fed by real requests and by
+    periodic probes. The score is `latency * (1 + error_penalty *
+    error_rate)`, lower is better. Hosts are probed once on first use
+    and again in the background every `probe_interval` seconds, each
+    probe giving up after `probe_timeout` seconds. The first request
+    waits for the first host to answer, not for every probe to finish.
+    '''
+    def __init__(self, hosts, alpha=DEFAULT_ALPHA,
+                 error_penalty=DEFAULT_ERROR_PENALTY,
+                 probe_interval=DEFAULT_PROBE_INTERVAL,
+                 probe_timeout=DEFAULT_PROBE_TIMEOUT):
+        self.hosts = list(hosts)
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        # - called as `prober(host, timeout)`
+        self.prober = None
+        self.__stats = dict((h, {'latency': None, 'error_rate': 0.0,
+                                 'requests': 0, 'failures': 0})
+                            for h in self.hosts)
+        self.__lock = threading.Lock()
+        self.__last_probe = None
+        self.__probing = False
+        self.__answered = threading.Event()
+
+    def report(self, host, elapsed, ok):
+        with self.__lock:
+            stats = self.__stats.get(host)
+            if stats is None:
+                return
+            stats['requests'] += 1
+            if ok:
+                if stats['latency'] is None:
+                    stats['latency'] = elapsed
+                else:
+                    stats['latency'] += self.alpha * (elapsed -
+                                                      stats['latency'])
+            else:
+                stats['failures'] += 1
+                if stats['latency'] is None:
+                    stats['latency'] = elapsed
+            stats['error_rate'] += self.alpha * ((0.0 if ok else 1.0) -
+                                                 stats['error_rate'])
+
+    def score(self, host):
+        with self.__lock:
+            return self.__score(self.__stats[host])
+
+    def rank(self):
+        '''Return the hosts, best first.'''
+        self.__maybe_probe()
+        with self.__lock:
+            return sorted(self.hosts,
+                          key=lambda h: self.__score(self.__stats[h]))
+
+    def best(self):
+        return self.rank()[0]
+
+    def scores(self):
+        '''Return a snapshot of the per host statistics for monitoring.'''
+        with self.__lock:
+            return dict((h, dict(s, score=self.__score(s)))
+                        for h, s in self.__stats.items())
+
+    def probe(self):
+        '''Measure every host once, in parallel, through `prober`.'''
+        if self.prober is None:
+            return
+        threads = [threading.Thread(target=self.__probe_one, args=(h,))
+                   for h in self.hosts]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    def __probe_one(self, host):
+        start = time.time()
+        try:
+            self.prober(host, self.probe_timeout)
+        except Exception:
+            self.report(host, time.time() - start, False)
+        else:
+            self.report(host, time.time() - start, True)
+            self.__answered.set()
+
+    def __maybe_probe(self):
+        with self.__lock:
+            now = time.time()
+            due = (self.__last_probe is None or
+                   now - self.__last_probe > self.probe_interval)
+            start = due and not self.__probing
+            if start:
+                self.__last_probe = now
+                self.__probing = True
+        if start:
+            t = threading.Thread(target=self.__run_probe)
+            t.daemon = True
+            t.start()
+        if not self.__answered.is_set():
+            # - until the first probe round, wait for the first host to
+            # - answer, a host that never does can not hold requests back
+            self.__answered.wait(self.probe_timeout)
+
+    def __run_probe(self):
+        try:
+            self.probe()
+        finally:
+            with self.__lock:
+                self.__probing = False
+            self.__answered.set()
+
+    def __score(self, stats):
+        if stats['latency'] is None:
+            # - hosts not measured yet come after every measured one
+            return float('inf')
+        return stats['latency'] * (1 + self.error_penalty *
+                                   stats['error_rate'])
@@ -3,12 +3,13 @@ from .compat import builtin_str
 
 
 class UpYunServiceException(Exception):
-    def __init__(self, request_id, status, msg, err):
+    def __init__(self, request_id, status, msg, err, headers=None):
         self.args = (request_id, status, msg, err)
         self.request_id = request_id
         self.status = status
         self.msg = msg
         self.err = err
+        self.headers = headers
 
 
 class UpYunClientException(Exception):
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import stat
+import time
+
+MIN_CHUNKSIZE = 8192
+INITIAL_CHUNKSIZE = 64 * 1024
+MAX_UPLOAD_CHUNKSIZE = 1024 * 1024
+MAX_DOWNLOAD_CHUNKSIZE = 1024 * 1024
+MAX_HASH_CHUNKSIZE = 4 * 1024 * 1024
+# - seconds a read / process loop iteration should take
+CHUNK_TARGET = 0.01
+
+
+def map_file(fileobj):
+    '''Return a read-only mmap of the whole on-disk file behind
+    `fileobj`, or None when it is not a non-empty regular file.
+    '''
+    try:
+        fd = fileobj.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode) or not st.st_size:
+        return None
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def close_map(mm):
+    try:
+        mm.close()
+    except BufferError:
+        # - still exported to a pending buffer, freed with its last user
+        pass
+
+
+def preallocate(fd, size):
+    '''Reserve `size` bytes for the file behind `fd`.'''
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, EnvironmentError):
+        os.ftruncate(fd, size)
+
+
+def pwrite(fd, data, offset, lock=None):
+    '''Write all of `data` at `offset` without moving the file position.
+
+    Platforms without `os.pwrite` fall back to seek + write under `lock`.
+    '''
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def pread(fileobj, size, offset, lock=None):
+    '''Read up to `size` bytes at `offset` without moving the position of
+    `fileobj`, so that several threads can read one file at once.
+
+    Files without a descriptor are sliced through `getbuffer` when they
+    are `BytesIO` objects, and read with seek + read under `lock`
+    otherwise.
+    '''
+    try:
+        fd = fileobj.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        fd = None
+    if fd is not None and hasattr(os, 'pread'):
+        data = os.pread(fd, size, offset)
+        if len(data) == size or not data:
+            return data
+        # - short read, only possible on special files
+        chunks = [data]
+        while data and size > len(data):
+            size -= len(data)
+            offset += len(data)
+            data = os.pread(fd, size, offset)
+            chunks.append(data)
+        return b''.join(chunks)
+    if hasattr(fileobj, 'getbuffer'):
+        view = fileobj.getbuffer()
+        try:
+            return bytes(view[offset:offset + size])
+        finally:
+            view.release()
+    with lock:
+        fileobj.seek(offset)
+        return fileobj.read(size)
+
+
+class AdaptiveChunkSize(object):
+    '''Size of the successive reads of one stream, tuned from the
+    measured throughput.
+
+    A chunk handled in less than half of `target` seconds doubles the
+    size, one taking more than twice as long halves it, so that each
+    iteration of the transfer loop moves about `target` seconds worth of
+    data. The size stays within `minimum` and `maximum`, which bounds
+    the memory held per stream. Calling the object returns the size.
+    '''
+    def __init__(self, initial=INITIAL_CHUNKSIZE, minimum=MIN_CHUNKSIZE,
+                 maximum=MAX_UPLOAD_CHUNKSIZE, target=CHUNK_TARGET):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.size = max(minimum, min(initial, maximum))
+
+    def __call__(self):
+        return self.size
+
+    def report(self, nbytes, seconds):
+        if nbytes < self.size:
+            # - a short read tells nothing about the throughput
+            return
+        if seconds < self.target / 2:
+            self.size = min(self.maximum, self.size * 2)
+        elif seconds > self.target * 2:
+            self.size = max(self.minimum, self.size // 2)
+
+
+class ChunkSizing(object):
+    '''Settings of the adaptive chunk sizes of a client, with separate
+    upper limits for uploads, downloads and hashing.
+    '''
+    def __init__(self, initial=INITIAL_CHUNKSIZE, minimum=MIN_CHUNKSIZE,
+                 upload=MAX_UPLOAD_CHUNKSIZE, download=MAX_DOWNLOAD_CHUNKSIZE,
+                 hashing=MAX_HASH_CHUNKSIZE, target=CHUNK_TARGET):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximums = {'upload': upload, 'download': download,
+                         'hashing': hashing}
+        self.target = target
+
+    def sizer(self, kind):
+        '''Return a new `AdaptiveChunkSize` for one `kind` stream.'''
+        return AdaptiveChunkSize(self.initial, self.minimum,
+                                 self.maximums[kind], self.target)
+
+
+def iter_chunks(read, chunksize):
+    '''Yield `read(size)` until it returns nothing. `chunksize` is a
+    size, or a callable such as an `AdaptiveChunkSize` read before each
+    call and told how long each chunk took to read and process.
+    '''
+    if not callable(chunksize):
+        for chunk in iter(lambda: read(chunksize), b''):
+            yield chunk
+        return
+    while True:
+        start = time.time()
+        chunk = read(chunksize())
+        if not chunk:
+            return
+        yield chunk
+        chunksize.report(len(chunk), time.time() - start)
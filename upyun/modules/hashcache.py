@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import threading
+import time
+
+from .exception import UpYunClientException
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+DEFAULT_HASH_CACHE = os.path.join(os.path.expanduser('~'), '.upyun',
+                                  'hashes.sqlite')
+DEFAULT_HASH_CACHE_SIZE = 100000
+# - files modified this recently may still change within the same mtime
+# - tick, their hashes are not kept
+RACY_WINDOW = 2
+TRIM_INTERVAL = 100
+
+
+def file_key(fileobj):
+    '''Return the `(device, inode, size, mtime_ns)` of the regular file
+    behind `fileobj`, or None.
+    '''
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+
+class HashCache(object):
+    '''Digests of local files kept in a SQLite database at `path`, so that
+    unchanged files are not hashed again, also across processes.
+
+    Entries are keyed by the device, inode, size and mtime of the file
+    plus a `kind` naming the digest, and the least recently used ones
+    are dropped beyond `maxsize` entries.
+    '''
+    def __init__(self, path=DEFAULT_HASH_CACHE,
+                 maxsize=DEFAULT_HASH_CACHE_SIZE):
+        if sqlite3 is None:
+            raise UpYunClientException('HashCache requires the sqlite3 '
+                                       'module')
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__db = sqlite3.connect(path, timeout=10,
+                                    check_same_thread=False)
+        self.__lock = threading.Lock()
+        self.__inserts = 0
+        with self.__lock, self.__db:
+            self.__db.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                'kind TEXT, digest TEXT, used REAL, '
+                'PRIMARY KEY (dev, ino, size, mtime_ns, kind))')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS hashes_used '
+                              'ON hashes (used)')
+
+    def get(self, fileobj, kind, compute):
+        '''Return the `kind` digest of `fileobj`, from the cache or from
+        `compute()`, which must return a string.
+        '''
+        key = file_key(fileobj)
+        if key is None:
+            return compute()
+        try:
+            with self.__lock, self.__db:
+                row = self.__db.execute(
+                    'SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND '
+                    'size = ? AND mtime_ns = ? AND kind = ?',
+                    key + (kind,)).fetchone()
+                if row is not None:
+                    self.__db.execute(
+                        'UPDATE hashes SET used = ? WHERE dev = ? AND '
+                        'ino = ? AND size = ? AND mtime_ns = ? AND kind = ?',
+                        (time.time(),) + key + (kind,))
+                    self.hits += 1
+                    return row[0]
+                self.misses += 1
+        except sqlite3.Error:
+            return compute()
+        digest = compute()
+        # - only keep digests of files left untouched while hashing
+        if (file_key(fileobj) == key and
+                key[3] < (time.time() - RACY_WINDOW) * 1e9):
+            self.__store(key, kind, digest)
+        return digest
+
+    def clear(self):
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM hashes')
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def __store(self, key, kind, digest):
+        try:
+            with self.__lock, self.__db:
+                self.__db.execute(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, '
+                    '?)', key + (kind, digest, time.time()))
+                self.__inserts += 1
+                if self.__inserts % TRIM_INTERVAL == 1:
+                    self.__trim()
+        except sqlite3.Error:
+            pass
+
+    def __trim(self):
+        count = self.__db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        if count > self.maxsize:
+            self.__db.execute(
+                'DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes '
+                'ORDER BY used LIMIT ?)', (count - self.maxsize,))
@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 import requests
 import datetime
+import threading
+import time
 import upyun
-import json
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    NewConnectionError = ()
 
 from .exception import UpYunServiceException, UpYunClientException
+from .compat import builtin_str, str
+from .retry import RetryPolicy, CONNECT_ERROR, READ_ERROR,\
+    parse_retry_after, mark_body, rewind_body
+from .endpoint import ED_SMART
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
 
 
 # - wsgiref.handlers.format_date_time
@@ -27,32 +45,125 @@ def cur_dt():
     return httpdate_rfc1123(datetime.datetime.utcnow())
 
 
+# - drop the idle sockets of a urllib3 pool, the pool itself stays usable
+def close_idle_connections(pool):
+    if pool.pool is None:
+        return
+    conns = []
+    while True:
+        try:
+            conns.append(pool.pool.get(block=False))
+        except queue.Empty:
+            break
+    for conn in conns:
+        if conn:
+            conn.close()
+        try:
+            pool.pool.put(None, block=False)
+        except queue.Full:
+            break
+
+
 class UpYunHttp(object):
-    def __init__(self, timeout, debug):
+    def __init__(self, timeout, debug, pool_connections=None,
+                 pool_maxsize=None, pool_block=False, keepalive=None,
+                 retry=None, selector=None):
         self.timeout = timeout
         self.debug = debug
+        self.keepalive = keepalive
+        if retry is None or retry is True:
+            retry = RetryPolicy()
+        self.retry = retry or None
+        self.selector = selector
+        if selector is not None:
+            selector.prober = self.__probe
+        self.user_agent = self.__make_user_agent()
+
+        # - one adapter shared by every host (rest, form, multipart, av),
+        # - urllib3 pools are thread safe, so a single UpYunHttp instance
+        # - can be used from many threads at the same time
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections or DEFAULT_POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize or DEFAULT_POOL_MAXSIZE,
+            pool_block=pool_block)
         self.session = requests.Session()
-        self.user_agent = None
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
 
-    # - http://docs.python-requests.org/
+        self.__lock = threading.Lock()
+        self.__last_used = {}
+
+    # - `retry=False` for callers running their own retry loop, so that
+    # - attempts are not multiplied by the two policies
     def do_http_pipe(self, method, host, uri,
-                     value=None, headers={}, stream=False, files=None):
-        request_id, msg, err, status = [None] * 4
-        url = 'http://%s%s' % (host, uri)
-        requests.adapters.DEFAULT_RETRIES = 5
+                     value=None, headers=None, stream=False, files=None,
+                     retry=True):
         headers = self.__set_headers(headers)
+        marks = mark_body(value, files)
+        if self.retry is None or not retry:
+            return self.__route(method, host, uri, value, headers,
+                                stream, files, marks)
+
+        self.retry.on_request()
+        attempt = 0
+        while True:
+            try:
+                return self.__route(method, host, uri, value, headers,
+                                    stream, files, marks)
+            except UpYunServiceException as se:
+                retry_after = parse_retry_after(
+                    (se.headers or {}).get('Retry-After'))
+                delay = self.retry.next_delay(method, attempt,
+                                              status=se.status,
+                                              retry_after=retry_after)
+                if delay is None or marks is None:
+                    raise
+            except UpYunClientException as ce:
+                error = self.__classify_error(ce.args[0])
+                delay = self.retry.next_delay(method, attempt, error=error)
+                if delay is None or marks is None:
+                    raise
+            if self.debug:
+                self.debug.log('retry', method=method, host=host, uri=uri,
+                               attempt=attempt + 1, delay=delay)
+            rewind_body(marks)
+            time.sleep(delay)
+            attempt += 1
+
+    # - ED_SMART requests go to the best scored host, and fail over to
+    # - the next one when a connection can not be established
+    def __route(self, method, host, uri, value, headers, stream, files,
+                marks):
+        if self.selector is None or host != ED_SMART:
+            return self.__request(method, host, uri, value, headers,
+                                  stream, files)
+        error = None
+        for candidate in self.selector.rank():
+            try:
+                return self.__request(method, candidate, uri, value,
+                                      headers, stream, files)
+            except UpYunClientException as ce:
+                if (self.__classify_error(ce.args[0]) != CONNECT_ERROR or
+                        marks is None):
+                    raise
+                error = ce
+                rewind_body(marks)
+        raise error
+
+    def __probe(self, host, timeout):
+        resp = self.session.request('HEAD', 'http://%s/' % host,
+                                    timeout=timeout,
+                                    headers={'User-Agent': self.user_agent})
+        resp.close()
 
-        if self.debug:
-            with open('debug.log', 'a') as f:
-                f.write('\n\n## Http request params ##\n\n')
-                kwargs = {'method': method, 'host': host, 'uri': uri,
-                          'value': value, 'headers': headers,
-                          'stream': stream, 'files': files,
-                          'timeout': self.timeout,
-                          }
-                f.write('\n'.join(map(lambda kv: '%s: %s'
-                                  % (kv[0], kv[1]), kwargs.items())))
+    # - http://docs.python-requests.org/
+    def __request(self, method, host, uri, value, headers, stream, files):
+        request_id, msg, err, status = [None] * 4
+        url = 'http://%s%s' % (host, uri)
 
+        start = time.time()
+        resp, error = None, None
+        self.__expire_idle(host)
         try:
             resp = self.session.request(method, url, data=value,
                                         headers=headers, stream=stream,
@@ -63,36 +174,97 @@ class UpYunHttp(object):
             except KeyError:
                 request_id = 'Unknown'
             status = resp.status_code
-            if status / 100 != 2:
+            if status // 100 != 2:
                 msg = resp.reason
                 err = resp.text
-
-            if self.debug:
-                with open('debug.log', 'a') as f:
-                    f.write('\n\n## Http responds ##\n\n')
-                    kwargs = {'request_id': request_id, 'status': status,
-                              'msg': msg, 'err': err}
-                    f.write('\n'.join(map(lambda kv: '%s: %s'
-                                      % (kv[0], kv[1]), kwargs.items())))
-
-        except requests.exceptions.ConnectionError as e:
-            raise UpYunClientException(e)
-        except requests.exceptions.RequestException as e:
-            raise UpYunClientException(e)
         except Exception as e:
+            error = e
             raise UpYunClientException(e)
+        finally:
+            self.__touch(host)
+            if self.selector is not None:
+                self.selector.report(host, time.time() - start,
+                                     error is None and status < 500)
+            if self.debug:
+                self.debug.log('http', method=method, host=host, uri=uri,
+                               headers=headers, status=status,
+                               request_id=request_id,
+                               request_bytes=self.__request_bytes(
+                                   value, headers),
+                               response_bytes=self.__response_bytes(
+                                   resp, stream),
+                               elapsed=time.time() - start,
+                               error=builtin_str(error or msg or '') or None)
 
         if msg:
-            raise UpYunServiceException(request_id, status, msg, err)
+            raise UpYunServiceException(request_id, status, msg, err,
+                                        resp.headers)
 
         return resp
 
+    def __classify_error(self, e):
+        exc = requests.exceptions
+        if isinstance(e, exc.ConnectTimeout):
+            return CONNECT_ERROR
+        if isinstance(e, exc.ConnectionError):
+            reason = getattr(e.args[0], 'reason', None) if e.args else None
+            if isinstance(reason, NewConnectionError):
+                return CONNECT_ERROR
+            return READ_ERROR
+        if isinstance(e, (exc.Timeout, exc.ChunkedEncodingError)):
+            return READ_ERROR
+        return None
+
+    def close(self):
+        self.session.close()
+
+    def __expire_idle(self, host):
+        if not self.keepalive:
+            return
+        with self.__lock:
+            last_used = self.__last_used.get(host)
+        if last_used is None or time.time() - last_used <= self.keepalive:
+            return
+        hostname, _, port = host.partition(':')
+        port = int(port or 80)
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool and pool.host == hostname and pool.port == port:
+                close_idle_connections(pool)
+
+    def __touch(self, host):
+        if self.keepalive:
+            with self.__lock:
+                self.__last_used[host] = time.time()
+
+    def __request_bytes(self, value, headers):
+        if 'Content-Length' in headers:
+            return int(headers['Content-Length'])
+        if hasattr(value, '__len__'):
+            return len(value)
+        return None
+
+    def __response_bytes(self, resp, stream):
+        if resp is None:
+            return None
+        if 'Content-Length' in resp.headers:
+            return int(resp.headers['Content-Length'])
+        if not stream:
+            return len(resp.content)
+        return None
+
     def __make_user_agent(self):
         default = 'upyun-python-sdk/%s' % upyun.__version__
-        return json.dumps(default, requests.utils.default_user_agent())
+        return '%s %s' % (default, requests.utils.default_user_agent())
 
     def __set_headers(self, headers):
-        headers['Date'] = cur_dt()
+        # - copy, callers may share (or default) the same dict across threads
+        headers = dict((k, v if isinstance(v, (str, builtin_str))
+                        else builtin_str(v))
+                       for k, v in (headers or {}).items())
+        if 'Date' not in headers:
+            headers['Date'] = cur_dt()
         if 'User-Agent' not in headers:
-            headers['User-Agent'] = self.__make_user_agent()
+            headers['User-Agent'] = self.user_agent
         return headers
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class WorkerPool(object):
+    '''A set of daemon threads running tasks from one shared queue.
+
+    Unlike `multiprocessing.dummy.Pool`, the input iterable of
+    `imap_unordered` is consumed lazily, so only `window` items are
+    ever pending at once whatever the size of the input.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.__tasks = queue.Queue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def imap_unordered(self, func, iterable, window=None):
+        '''Run `func` over `iterable` and yield `(item, result, error)`
+        tuples in completion order; `error` is the raised exception or
+        None. At most `window` (default: pool size) items are in flight,
+        `window` may also be a callable read before each submission, such
+        as an `AdaptiveLimit`.
+        '''
+        self.__start()
+        if not callable(window):
+            window = (lambda size: lambda: size)(window or self.size)
+        results = queue.Queue()
+        cancelled = threading.Event()
+        items = iter(iterable)
+        inflight = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and inflight < window():
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.__tasks.put((func, item, results, cancelled))
+                    inflight += 1
+                if not inflight:
+                    return
+                res = results.get()
+                inflight -= 1
+                yield res
+        finally:
+            # - the caller stopped early, skip what is still queued
+            cancelled.set()
+
+    def imap_tree(self, func, roots, children, window=None):
+        '''Like `imap_unordered` over a tree: after `func(item)` succeeds,
+        the items returned by `children(item, result)` are run as well.
+        '''
+        self.__start()
+        window = window or self.size
+        results = queue.Queue()
+        cancelled = threading.Event()
+        pending = deque(roots)
+        inflight = 0
+        try:
+            while pending or inflight:
+                while pending and inflight < window:
+                    self.__tasks.put((func, pending.popleft(), results,
+                                      cancelled))
+                    inflight += 1
+                item, result, error = results.get()
+                inflight -= 1
+                if error is None:
+                    pending.extend(children(item, result))
+                yield item, result, error
+        finally:
+            cancelled.set()
+
+    def map(self, func, iterable, window=None):
+        '''Like `imap_unordered` but raise the first error, and return
+        the results in input order once every item is done.
+        '''
+        items = list(iterable)
+        results = {}
+        for index, result, error in self.imap_unordered(
+                lambda i: func(items[i]), range(len(items)), window):
+            if error is not None:
+                raise error
+            results[index] = result
+        return [results[i] for i in range(len(items))]
+
+    def grow(self, size):
+        '''Raise the number of worker threads to at least `size`.'''
+        with self.__lock:
+            self.size = max(self.size, size)
+
+    def close(self, wait=False):
+        '''Stop the worker threads once the queued tasks are done; with
+        `wait`, also block until they exit, so that no task of this pool
+        is still running on return.
+        '''
+        with self.__lock:
+            if not self.__closed:
+                self.__closed = True
+                for _ in self.__threads:
+                    self.__tasks.put(None)
+            threads = list(self.__threads)
+        if wait:
+            for t in threads:
+                if t is not threading.current_thread():
+                    t.join()
+
+    def __start(self):
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('WorkerPool is closed')
+            while len(self.__threads) < self.size:
+                t = threading.Thread(target=self.__work,
+                                     name='upyun-worker')
+                t.daemon = True
+                t.start()
+                self.__threads.append(t)
+
+    def __work(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            func, item, results, cancelled = task
+            if cancelled.is_set():
+                continue
+            # - every task must produce a result, or its consumer waits
+            # - forever, so even KeyboardInterrupt or SystemExit are handed
+            # - over to be raised in the consuming thread
+            try:
+                results.put((item, func(item), None))
+            except BaseException as e:
+                results.put((item, None, e))
+
+
+class AdaptiveLimit(object):
+    '''Concurrency limit tuned from the measured throughput (AIMD).
+
+    Completions are grouped in rounds of `limit` items. When a round is
+    more than `tolerance` faster than the previous one the limit grows
+    by one, when it is that much slower the limit shrinks by one, and
+    any failure halves it at once. The limit stays within `minimum` and
+    `maximum`. Calling the object returns the current limit.
+    '''
+    def __init__(self, initial=4, minimum=1, maximum=32, tolerance=0.05):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.__lock = threading.Lock()
+        self.__last_rate = None
+        self.__reset()
+
+    def __call__(self):
+        return self.limit
+
+    def report(self, nbytes, ok=True):
+        with self.__lock:
+            if not ok:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.__last_rate = None
+                self.__reset()
+                return
+            self.__bytes += nbytes
+            self.__count += 1
+            if self.__count < self.limit:
+                return
+            rate = self.__bytes / max(time.time() - self.__start, 1e-6)
+            if (self.__last_rate is None or
+                    rate > self.__last_rate * (1 + self.tolerance)):
+                self.limit = min(self.maximum, self.limit + 1)
+            elif rate < self.__last_rate * (1 - self.tolerance):
+                self.limit = max(self.minimum, self.limit - 1)
+            self.__last_rate = rate
+            self.__reset()
+
+    def __reset(self):
+        self.__bytes = 0
+        self.__count = 0
+        self.__start = time.time()
+
+
+class StageTimer(object):
+    '''Busy time and item count of each stage of a pipeline.'''
+    def __init__(self):
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.__lock:
+            stats = self.__stats.setdefault(name, {'seconds': 0.0,
+                                                   'items': 0})
+            stats['seconds'] += seconds
+            stats['items'] += 1
+
+    def snapshot(self):
+        with self.__lock:
+            return dict((k, dict(v)) for k, v in self.__stats.items())
+
+
+def prefetch(func, items, maxsize, timer=None, name=None):
+    '''Apply `func` to `items` in a background thread and yield the
+    results in order, keeping at most `maxsize` of them ready ahead of
+    the consumer. With `func` None the items are passed through and the
+    time spent producing them is recorded instead. Errors are raised to
+    the consumer; closing the generator stops the thread.
+    '''
+    results = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                results.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        it = iter(items)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                if func is not None:
+                    start = time.time()
+                    item = func(item)
+                if timer is not None:
+                    timer.add(name, time.time() - start)
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put(None)
+
+    t = threading.Thread(target=run, name='upyun-%s' % (name or 'stage'))
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            entry = results.get()
+            if entry is None:
+                return
+            item, error = entry
+            if error is not None:
+                raise error
+            yield item
+    finally:
+        stop.set()
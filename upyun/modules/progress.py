@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+
+DEFAULT_PROGRESS_INTERVAL = 0.1
+DEFAULT_MONITOR_WINDOW = 5
+
+
+class TransferProgress(object):
+    '''Count the bytes of one transfer, possibly moved by several
+    threads, and pass them on to a `handler(totalsize, params)` object
+    and to a `TransferMonitor`.
+
+    `handler.update(readsofar)` is called at most once per `interval`
+    seconds, or once per `step` bytes, whichever comes first; with
+    neither set it is called on every update. `handler.finish()` is
+    always called once the transfer is complete. `done` bytes, e.g. of
+    a resumed transfer, are counted as already moved.
+    '''
+    def __init__(self, totalsize, handler=None, params=None, monitor=None,
+                 interval=DEFAULT_PROGRESS_INTERVAL, step=None, done=0):
+        self.totalsize = totalsize
+        self.readsofar = done
+        self.hdr = handler(totalsize, params) if handler else None
+        self.monitor = monitor
+        self.interval = interval
+        self.step = step
+        self.lock = threading.Lock()
+        self.__reported = done
+        self.__last = time.time()
+        self.__closed = False
+        if monitor is not None:
+            monitor.start(totalsize - done)
+
+    def update(self, n):
+        with self.lock:
+            self.readsofar += n
+            if self.readsofar >= self.totalsize:
+                self.__close(True)
+                return
+            now = time.time()
+            due = ((self.interval is None and not self.step) or
+                   (self.interval is not None and
+                    now - self.__last >= self.interval) or
+                   (self.step and
+                    self.readsofar - self.__reported >= self.step))
+            if not due:
+                return
+            self.__last = now
+            self.__report()
+            if self.hdr:
+                self.hdr.update(self.readsofar)
+
+    def finish(self):
+        with self.lock:
+            self.readsofar = max(self.readsofar, self.totalsize)
+            self.__close(True)
+
+    def abort(self):
+        '''End a failed transfer, without calling `handler.finish`.'''
+        with self.lock:
+            self.__close(False)
+
+    def __report(self):
+        if self.monitor is not None:
+            self.monitor.update(self.readsofar - self.__reported)
+        self.__reported = self.readsofar
+
+    def __close(self, ok):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__report()
+        if self.monitor is not None:
+            self.monitor.finish(ok, self.totalsize - self.readsofar)
+        if ok and self.hdr:
+            self.hdr.finish()
+
+
+class ProgressReporter(object):
+    '''Create the `TransferProgress` of each transfer of a client, or
+    None when there is nobody to report to.
+    '''
+    def __init__(self, monitor=None, interval=DEFAULT_PROGRESS_INTERVAL,
+                 step=None):
+        self.monitor = monitor
+        self.interval = interval
+        self.step = step
+
+    def __call__(self, totalsize, handler=None, params=None, done=0):
+        if handler is None and self.monitor is None:
+            return None
+        return TransferProgress(totalsize, handler, params, self.monitor,
+                                self.interval, self.step, done)
+
+
+class TransferMonitor(object):
+    '''Aggregate the progress of every transfer of one or more clients.
+
+    `snapshot()` gives the number of transfers started, active and
+    failed, the bytes moved out of those expected, the throughput over
+    the last `window` seconds and the estimated time left.
+    '''
+    def __init__(self, window=DEFAULT_MONITOR_WINDOW):
+        self.window = window
+        self.transfers = 0
+        self.active = 0
+        self.failed = 0
+        self.bytes = 0
+        self.total = 0
+        self.__samples = deque()
+        self.__lock = threading.Lock()
+
+    def start(self, totalsize):
+        with self.__lock:
+            self.transfers += 1
+            self.active += 1
+            self.total += totalsize
+
+    def update(self, n):
+        now = time.time()
+        with self.__lock:
+            self.bytes += n
+            self.__samples.append((now, self.bytes))
+            while self.__samples[0][0] < now - self.window:
+                self.__samples.popleft()
+
+    def finish(self, ok=True, unsent=0):
+        with self.__lock:
+            self.active -= 1
+            if not ok:
+                self.failed += 1
+                # - failed transfers no longer count toward the eta
+                self.total -= max(0, unsent)
+
+    def snapshot(self):
+        now = time.time()
+        with self.__lock:
+            throughput = 0.0
+            samples = [s for s in self.__samples if s[0] >= now - self.window]
+            if samples:
+                # - bytes moved since the oldest sample still in the window
+                since, base = samples[0]
+                elapsed = now - since
+                if len(samples) > 1 and elapsed > 0:
+                    throughput = (self.bytes - base) / elapsed
+            eta = None
+            if throughput > 0:
+                eta = max(0, self.total - self.bytes) / throughput
+            return {'transfers': self.transfers, 'active': self.active,
+                    'failed': self.failed, 'bytes': self.bytes,
+                    'total': self.total, 'throughput': throughput,
+                    'eta': eta}
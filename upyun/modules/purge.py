@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import atexit
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from .compat import builtin_str, quote
+from .exception import UpYunClientException
+from .sign import encode_msg
+
+DEFAULT_PURGE_DELAY = 1.0
+DEFAULT_PURGE_URLS = 200
+DEFAULT_PURGE_BYTES = 32 * 1024
+
+# - batchers are only referenced weakly here, an idle batcher has no
+# - thread either, so one that is no longer used can be collected
+_batchers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_batchers():
+    for batcher in list(_batchers):
+        batcher.close()
+
+
+class PurgeTicket(object):
+    '''The outcome of one `PurgeBatcher.submit` call.'''
+    def __init__(self, keys):
+        self.keys = keys
+        self.invalid = []
+        self.error = None
+        self.__remaining = len(keys)
+        self.__lock = threading.Lock()
+        self.__done = threading.Event()
+        if not keys:
+            self.__done.set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        '''Wait for every key to be sent and return those the API
+        reported as invalid; raise the error of a failed request.
+        '''
+        if not self.__done.wait(timeout):
+            raise UpYunClientException('purge still pending')
+        if self.error is not None:
+            raise self.error
+        return sorted(self.invalid)
+
+    def _complete(self, key, invalid, error):
+        with self.__lock:
+            if invalid:
+                self.invalid.append(key)
+            if error is not None and self.error is None:
+                self.error = error
+            self.__remaining -= 1
+            if not self.__remaining:
+                self.__done.set()
+
+
+class PurgeBatcher(object):
+    '''Collect purge requests and send them in batches.
+
+    Submitted keys are queued per domain, duplicates are merged, and a
+    background thread sends them once `max_urls` keys are pending or the
+    oldest one waited `max_delay` seconds. Each request carries at most
+    `max_urls` URLs and about `max_bytes` bytes of form body. `purge` is
+    called as `purge(keys, domain)` and returns the invalid keys.
+
+    The thread only runs while keys are pending. What is still pending
+    at exit is sent before the interpreter stops.
+    '''
+    def __init__(self, purge, max_delay=DEFAULT_PURGE_DELAY,
+                 max_urls=DEFAULT_PURGE_URLS, max_bytes=DEFAULT_PURGE_BYTES):
+        self.purge = purge
+        self.max_delay = max_delay
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.requests = 0
+        self.urls = 0
+        self.__pending = OrderedDict()
+        self.__count = 0
+        self.__first = None
+        self.__cond = threading.Condition()
+        self.__thread = None
+        self.__closed = False
+        _batchers.add(self)
+
+    def submit(self, keys, domain=None):
+        '''Queue `keys` (a key or a list of keys) and return a
+        `PurgeTicket` for them.
+        '''
+        if isinstance(keys, builtin_str):
+            keys = [keys]
+        keys = list(OrderedDict.fromkeys('/' + k.lstrip('/') for k in keys))
+        ticket = PurgeTicket(keys)
+        with self.__cond:
+            if self.__closed:
+                raise UpYunClientException('purge batcher is closed')
+            pending = self.__pending.setdefault(domain, OrderedDict())
+            for key in keys:
+                if key not in pending:
+                    pending[key] = []
+                    self.__count += 1
+                pending[key].append(ticket)
+            if self.__first is None:
+                self.__first = time.time()
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name='upyun-purge')
+                self.__thread.daemon = True
+                self.__thread.start()
+            if self.__count >= self.max_urls:
+                self.__cond.notify()
+        return ticket
+
+    def flush(self):
+        '''Send everything pending now, in the calling thread.'''
+        with self.__cond:
+            batch = self.__take()
+        self.__send(batch)
+
+    def close(self):
+        '''Send what is pending and stop the background thread.'''
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__cond.notify()
+            thread = self.__thread
+        if thread is not None:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__closed and self.__count < self.max_urls:
+                    if self.__first is None:
+                        # - nothing pending, the next submit starts a
+                        # - new thread
+                        self.__thread = None
+                        return
+                    wait = self.__first + self.max_delay - time.time()
+                    if wait <= 0:
+                        break
+                    self.__cond.wait(wait)
+                batch = self.__take()
+                if self.__closed and not batch:
+                    return
+            self.__send(batch)
+
+    def __take(self):
+        batch = self.__pending
+        self.__pending = OrderedDict()
+        self.__count = 0
+        self.__first = None
+        return batch
+
+    def __send(self, batch):
+        for domain, pending in batch.items():
+            for chunk in self.__chunks(list(pending), domain):
+                invalid, error = (), None
+                try:
+                    invalid = set(self.purge(chunk, domain))
+                except Exception as e:
+                    error = e
+                self.requests += 1
+                self.urls += len(chunk)
+                for key in chunk:
+                    for ticket in pending[key]:
+                        ticket._complete(key, key in invalid, error)
+
+    def __chunks(self, keys, domain):
+        chunk, size = [], 0
+        for key in keys:
+            # - the length of the url once form encoded, the default
+            # - domain is counted at the length of a typical one
+            n = len(quote(encode_msg('http://%s%s\n' % (
+                domain or 'bucket.b0.upaiyun.com', key)), safe=''))
+            if chunk and (len(chunk) >= self.max_urls or
+                          size + n > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(key)
+            size += n
+        if chunk:
+            yield chunk
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import random
+import threading
+import time
+
+from .compat import builtin_str, str
+
+CONNECT_ERROR = 'connect'
+READ_ERROR = 'read'
+
+DEFAULT_METHODS = ('GET', 'HEAD', 'DELETE')
+DEFAULT_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    '''Return the `Retry-After` header value in seconds, or None.'''
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def mark_body(value, files=None):
+    '''Remember where each file-like part of a request body starts.
+
+    Return a list of (fileobj, position) pairs, or None when the body
+    can not be sent twice (e.g. a generator).
+    '''
+    parts = [value]
+    if files:
+        parts.extend(v[1] if isinstance(v, tuple) else v
+                     for v in files.values())
+    marks = []
+    for part in parts:
+        if part is None or isinstance(part, (str, builtin_str)):
+            continue
+        try:
+            memoryview(part)
+            continue
+        except TypeError:
+            pass
+        try:
+            marks.append((part, part.tell()))
+        except (AttributeError, IOError, OSError):
+            return None
+    return marks
+
+
+def rewind_body(marks):
+    for fileobj, position in marks:
+        fileobj.seek(position)
+
+
+class RetryBudget(object):
+    '''Token bucket capping retries to a fraction of the traffic.
+
+    Every request earns `ratio` tokens, every retry spends one, and the
+    bucket holds at most `burst` tokens.
+    '''
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+        self.__lock = threading.Lock()
+
+    def deposit(self):
+        with self.__lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.__lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    '''Decide whether, and after how long, a failed request is retried.
+
+    `methods` are retried on `statuses` and on network errors, a
+    request that failed before a connection was made is retried
+    whatever its method. Delays grow as `backoff_factor * 2 ** n`, up to
+    `backoff_max`, with full jitter when `jitter` is set. A server
+    `Retry-After` hint is used as the minimum delay; when it asks for
+    more than `retry_after_max` seconds the error is raised instead.
+    All retries share one `RetryBudget`.
+    '''
+    def __init__(self, total=3, methods=DEFAULT_METHODS,
+                 statuses=DEFAULT_STATUSES, backoff_factor=0.1,
+                 backoff_max=10, jitter=True, retry_after_max=60,
+                 budget=None):
+        self.total = total
+        self.methods = frozenset(m.upper() for m in methods)
+        self.statuses = frozenset(statuses)
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_after_max = retry_after_max
+        self.budget = budget if budget is not None else RetryBudget()
+        self.retries = 0
+        self.__lock = threading.Lock()
+
+    def on_request(self):
+        self.budget.deposit()
+
+    def is_retryable(self, method, status=None, error=None):
+        if error == CONNECT_ERROR:
+            return True
+        if method.upper() not in self.methods:
+            return False
+        if error is not None:
+            return True
+        return status in self.statuses
+
+    def next_delay(self, method, attempt, status=None, error=None,
+                   retry_after=None):
+        '''Return seconds to wait before retry number `attempt` + 1, or
+        None if the failure must be raised.
+        '''
+        if attempt >= self.total:
+            return None
+        if not self.is_retryable(method, status, error):
+            return None
+        if retry_after is not None and retry_after > self.retry_after_max:
+            return None
+        if not self.budget.withdraw():
+            return None
+        delay = min(self.backoff_max, self.backoff_factor * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        with self.__lock:
+            self.retries += 1
+        return delay
@@ -6,14 +6,29 @@ import json
 
 from .compat import b, PY3, builtin_str, bytes, str
 from .exception import UpYunClientException
+from .fileio import map_file, close_map, iter_chunks
 
 DEFAULT_CHUNKSIZE = 8192
 
 
-def make_content_md5(value, chunksize=DEFAULT_CHUNKSIZE):
+def make_content_md5(value, chunksize=DEFAULT_CHUNKSIZE, cache=None):
+    if cache is not None and hasattr(value, 'fileno'):
+        # - a cache hit does not read the file, but rewinds it as well
+        md5 = cache.get(value, 'md5',
+                        lambda: make_content_md5(value, chunksize))
+        value.seek(0)
+        return md5
     if hasattr(value, 'fileno'):
+        # - on-disk files are hashed straight from the page cache
+        mm = map_file(value)
+        if mm is not None:
+            try:
+                return hashlib.md5(mm).hexdigest()
+            finally:
+                close_map(mm)
+                value.seek(0)
         md5 = hashlib.md5()
-        for chunk in iter(lambda: value.read(chunksize), b''):
+        for chunk in iter_chunks(value.read, chunksize):
             md5.update(chunk)
         value.seek(0)
         return md5.hexdigest()
@@ -24,6 +39,62 @@ def make_content_md5(value, chunksize=DEFAULT_CHUNKSIZE):
         raise UpYunClientException('object type error')
 
 
+def make_multipart_md5(value, block_size, pool=None, cache=None):
+    '''Return the MD5 of the whole of `value` and the list of the MD5
+    of each `block_size` block, reading the data once.
+
+    On-disk files (through mmap) and `BytesIO` objects are hashed in
+    place, and the whole-file digest and block digests then run side by
+    side on `pool` (hashlib releases the GIL on large buffers). Other
+    streams are read block by block and feed both digests. With a
+    `HashCache`, digests of unchanged files are not computed again.
+    '''
+    if cache is not None:
+        return tuple(json.loads(cache.get(
+            value, 'multipart-%d' % block_size,
+            lambda: json.dumps(make_multipart_md5(value, block_size, pool)))))
+    mm = map_file(value)
+    buf = None
+    try:
+        if mm is not None:
+            buf = memoryview(mm)
+        elif hasattr(value, 'getbuffer'):
+            buf = value.getbuffer()
+    except TypeError:
+        pass
+    if buf is None:
+        if mm is not None:
+            close_map(mm)
+        return _make_multipart_md5_stream(value, block_size)
+
+    def digest(start):
+        if start is None:
+            return hashlib.md5(buf).hexdigest()
+        return hashlib.md5(buf[start:start + block_size]).hexdigest()
+    try:
+        jobs = [None] + (list(range(0, len(buf), block_size)) or [0])
+        if pool is not None:
+            hashes = pool.map(digest, jobs)
+        else:
+            hashes = [digest(start) for start in jobs]
+        return hashes[0], hashes[1:]
+    finally:
+        if hasattr(buf, 'release'):
+            buf.release()
+        if mm is not None:
+            close_map(mm)
+
+
+def _make_multipart_md5_stream(value, block_size):
+    md5 = hashlib.md5()
+    blocks = []
+    for chunk in iter(lambda: value.read(block_size), b''):
+        md5.update(chunk)
+        blocks.append(hashlib.md5(chunk).hexdigest())
+    value.seek(0)
+    return md5.hexdigest(), blocks or [md5.hexdigest()]
+
+
 def decode_msg(msg):
     if isinstance(msg, bytes):
         msg = msg.decode('utf-8')
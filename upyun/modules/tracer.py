@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import atexit
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .compat import builtin_str, str
+
+REDACTED = '******'
+DEFAULT_REDACT = ('authorization', 'content-secret', 'password', 'secret',
+                  'signature', 'token_secret', 'policy')
+DEFAULT_QUEUE_SIZE = 10000
+
+
+def redact(value, keys):
+    if isinstance(value, dict):
+        return dict((k, REDACTED if k.lower() in keys else redact(v, keys))
+                    for k, v in value.items())
+    return value
+
+
+# - the writer thread and queue of every open DebugLogger, keyed by a
+# - weak reference so that a logger no longer used is closed as well
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def _stop_logger(ref, wait=True):
+    with _loggers_lock:
+        entry = _loggers.pop(ref, None)
+    if entry is None:
+        return
+    records, thread = entry
+    records.put(None)
+    if wait and thread is not threading.current_thread():
+        thread.join()
+
+
+@atexit.register
+def _close_loggers():
+    for ref in list(_loggers):
+        _stop_logger(ref)
+
+
+def _run_writer(records_queue, sink, owns_sink):
+    while True:
+        records = [records_queue.get()]
+        while True:
+            try:
+                records.append(records_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write(sink, [r for r in records if r is not None])
+        except Exception:
+            pass
+        finally:
+            for _ in records:
+                records_queue.task_done()
+        if None in records:
+            if owns_sink:
+                sink.close()
+            return
+
+
+def _write(sink, records):
+    if not records:
+        return
+    if isinstance(sink, logging.Logger):
+        for record in records:
+            sink.debug(json.dumps(record, default=repr))
+    elif hasattr(sink, 'write'):
+        sink.write(''.join(json.dumps(r, default=repr) + '\n'
+                           for r in records))
+        if hasattr(sink, 'flush'):
+            sink.flush()
+    else:
+        for record in records:
+            sink(record)
+
+
+class DebugLogger(object):
+    '''Structured, non-blocking logger used when `debug` is enabled.
+
+    Records are dicts put on a bounded in-memory queue and written by a
+    background thread, one JSON object per line. `sink` may be a file
+    path, a file-like object, a `logging.Logger` or any callable taking
+    the record dict. `sample` is the fraction of successful requests to
+    keep, failed requests are always recorded. Values whose key appears
+    in `redact` are masked before they reach the queue. When the queue
+    is full new records are dropped (and counted) instead of blocking
+    the caller.
+
+    The thread stops, and a sink opened from a path is closed, on
+    `close()`, once the logger is garbage collected, or at exit.
+    '''
+    def __init__(self, sink='debug.log', sample=1.0, redact=DEFAULT_REDACT,
+                 maxsize=DEFAULT_QUEUE_SIZE):
+        self.sample = sample
+        self.redact = frozenset(k.lower() for k in redact)
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize)
+        self.__lock = threading.Lock()
+        self.__closed = False
+        owns_sink = False
+        if isinstance(sink, (str, builtin_str)):
+            sink = open(sink, 'a')
+            owns_sink = True
+        self.sink = sink
+        # - the thread holds no reference to the logger itself
+        thread = threading.Thread(target=_run_writer,
+                                  args=(self.queue, sink, owns_sink),
+                                  name='upyun-debug-logger')
+        thread.daemon = True
+        thread.start()
+        self.__ref = weakref.ref(
+            self, lambda ref: _stop_logger(ref, wait=False))
+        with _loggers_lock:
+            _loggers[self.__ref] = (self.queue, thread)
+
+    def log(self, event, **fields):
+        if self.__closed:
+            return
+        if (event == 'http' and not fields.get('error') and
+                self.sample < 1 and random.random() >= self.sample):
+            return
+        fields['event'] = event
+        fields.setdefault('time', time.time())
+        try:
+            self.queue.put_nowait(redact(fields, self.redact))
+        except queue.Full:
+            with self.__lock:
+                self.dropped += 1
+
+    def flush(self):
+        '''Block until every queued record has been written.'''
+        self.queue.join()
+
+    def close(self):
+        self.__closed = True
+        _stop_logger(self.__ref)
@@ -2,73 +2,249 @@
 import os
 import time
 import math
-import itertools
+import hashlib
 import threading
-from multiprocessing.dummy import Pool as ThreadPool
 
 from .modules.compat import urlencode, b
 from .modules.exception import UpYunServiceException, UpYunClientException
-from .modules.sign import make_policy, make_multi_signature, make_content_md5
+from .modules.sign import make_policy, make_multi_signature,\
+    make_content_md5, make_multipart_md5
+from .modules.fileio import pread
+from .modules.pool import WorkerPool, AdaptiveLimit, StageTimer, prefetch
+from .modules.retry import RetryPolicy, READ_ERROR, parse_retry_after
+from .modules.checkpoint import UploadJournal
+from .modules.progress import ProgressReporter
+
+DEFAULT_CONCURRENCY = 4
+MAX_AUTO_CONCURRENCY = 32
+DEFAULT_BLOCK_RETRIES = 5
+# - blocks read and signed ahead of the uploaders, per stage
+READ_AHEAD = 2
+DEFAULT_JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.upyun',
+                                   'multipart')
+
+
+def iter_blocks(source, block_size):
+    '''Yield `block_size` bytes blocks, the last one possibly shorter,
+    from a readable object or an iterable of byte strings.
+    '''
+    if hasattr(source, 'read'):
+        pieces = iter(lambda: source.read(block_size), b'')
+    else:
+        pieces = iter(source)
+    buf = bytearray()
+    empty = True
+    for piece in pieces:
+        buf += piece
+        while len(buf) >= block_size:
+            yield bytes(buf[:block_size])
+            del buf[:block_size]
+            empty = False
+    if buf or empty:
+        yield bytes(buf)
 
 
 class Multipart(object):
-    def __init__(self, bucket, secret, endpoint, hp):
+    def __init__(self, bucket, secret, endpoint, hp, hash_cache=None,
+                 progress=None):
         self.bucket = bucket
         self.secret = secret
         self.hp = hp
+        self.hash_cache = hash_cache
+        self.progress = progress or ProgressReporter()
         self.host = 'm0.api.upyun.com'
         self.uri = '/%s/' % bucket
+        self.pool = None
+        self.stage_timings = {}
+        # - blocks are idempotent, so unlike other POSTs they are retried
+        self.retry = None
+        if hp.retry is not None:
+            self.retry = RetryPolicy(total=DEFAULT_BLOCK_RETRIES,
+                                     methods=('POST',), backoff_factor=0.5)
+        self.__lock = threading.Lock()
 
     # --- public API
-    def upload(self, key, value, block_size, expiration, **kwargs):
+    def upload(self, key, value, block_size, expiration,
+               concurrency=None, journal=None, handler=None, params=None,
+               **kwargs):
+        '''`concurrency` is the number of blocks in flight, or 'auto' to
+        adjust it from the measured block throughput and failures.
+        `journal` (True or a directory) keeps the upload session and the
+        saved blocks on disk, so that uploading the same unchanged file
+        again resumes it.
+        '''
+        limit, pool = self.__get_limit(concurrency)
         lock = threading.Lock()
-        expiration = expiration or 1800
-        expiration = int(expiration + time.time())
+        ttl = expiration
         block_size = block_size or 1024*1024
         file_size = int(self.__get_size(value))
         block_size = self.__check_size(block_size)
-        blocks = int(math.ceil(file_size / block_size)) or 1
-
-        # - init upload
-        content = self.__init_upload(key, value,
-                                     file_size, blocks, expiration, **kwargs)
-        if 'save_token' in content and 'token_secret' in content:
-            save_token = content['save_token']
-            token_secret = content['token_secret']
-        else:
-            raise UpYunServiceException(None, 503, 'Service unavailable',
-                                        'Not enough response datas from api')
-        status = self.__get_status(content)
+        blocks = int(math.ceil(file_size / float(block_size))) or 1
 
-        # - block item upload
-        retry = 0
-        pool = ThreadPool(4)
-        while not self.__upload_success(status) and retry < 5:
-            status_list = pool.map(lambda parms: self.__block_upload(*parms),
-                                   zip(range(blocks), itertools.repeat(
-                                       (status, value, file_size,
-                                        block_size, expiration,
-                                        save_token, token_secret, lock))
-                                       ))
-            status = self.__find_max_status(status_list)
-            retry += 1
-        pool.close()
-        pool.join()
-
-        # - end upload
-        if self.__upload_success(status):
-            return self.__end_upload(expiration, save_token, token_secret)
+        record = None
+        if journal:
+            record = UploadJournal(self.__journal_path(
+                journal, key, value, file_size, block_size))
+        state = record.load() if record else None
+        if state is None:
+            # - one read of the file gives the file hash and the hashes of
+            # - every block, the uploader does not hash blocks again
+            file_hash, block_hashes = make_multipart_md5(value, block_size,
+                                                         pool,
+                                                         self.hash_cache)
+            save_token, token_secret, expiration, status =\
+                self.__init_upload(key, file_hash, file_size, blocks,
+                                   expiration, **kwargs)
+            if record:
+                record.start(save_token=save_token, token_secret=token_secret,
+                             expiration=expiration, status=status)
         else:
-            UpYunServiceException(None, 500, 'Upload failed',
-                                  'Failed to upload the whole '
-                                  'file within retry times')
+            block_hashes = None
+            save_token = state['save_token']
+            token_secret = state['token_secret']
+            expiration = state['expiration']
+            status = state['status']
+
+        # - block item upload: only the missing blocks are queued, each
+        # - one retried on its own, and every response merged into status
+        parms = (value, file_size, block_size, expiration,
+                 save_token, token_secret, lock, limit, block_hashes)
+        pending = [i for i in range(blocks) if not status[i]]
+        saved = sum(min(block_size, file_size - i * block_size)
+                    for i in range(blocks) if status[i])
+        progress = self.progress(file_size, handler, params, saved)
+        try:
+            try:
+                status = self.__send_blocks(
+                    pending, lambda i: self.__read_block(i, parms),
+                    status, parms, pool, limit, record, progress)
+            except UpYunServiceException as se:
+                if state is None or not 400 <= se.status < 500:
+                    raise
+                # - the journaled session was rejected, start a new one
+                record.remove()
+                return self.upload(key, value, block_size, ttl, concurrency,
+                                   journal, handler, params, **kwargs)
+
+            # - end upload
+            if not self.__upload_success(status):
+                raise UpYunServiceException(None, 500, 'Upload failed',
+                                            'Failed to upload the whole '
+                                            'file within retry times')
+            res = self.__end_upload(expiration, save_token, token_secret)
+            if progress is not None:
+                progress.finish()
+        finally:
+            if progress is not None:
+                # - no-op once finished
+                progress.abort()
+        if record:
+            record.remove()
+        return res
+
+    def upload_stream(self, key, value, file_size, file_hash, block_size,
+                      expiration, concurrency=None, handler=None, params=None,
+                      **kwargs):
+        '''Upload `file_size` bytes read from a stream, or from an iterable
+        of byte strings, that can not seek. Blocks are uploaded as they
+        fill and only the blocks in flight are held in memory. The init
+        request of the API needs the MD5 of the whole file, so the caller
+        has to provide it as `file_hash`; it is checked against the data
+        before the upload is completed.
+
+        >>> p = subprocess.Popen(['tar', 'c', 'dir'], stdout=PIPE)
+        >>> up.put('/dir.tar', p.stdout, multipart=True,
+        >>>        file_size=size, file_hash=md5)
+        '''
+        if not file_hash:
+            raise UpYunClientException('file_hash is required to upload '
+                                       'a stream')
+        limit, pool = self.__get_limit(concurrency)
+        file_size = int(file_size)
+        block_size = self.__check_size(block_size or 1024*1024)
+        blocks = int(math.ceil(file_size / float(block_size))) or 1
+        save_token, token_secret, expiration, status =\
+            self.__init_upload(key, file_hash, file_size, blocks,
+                               expiration, **kwargs)
+
+        md5 = hashlib.md5()
+        received = [0]
+
+        def read_blocks():
+            # - pulled lazily by the pipeline, memory stays bounded
+            for index, data in enumerate(iter_blocks(value, block_size)):
+                received[0] += len(data)
+                if received[0] > file_size:
+                    raise UpYunClientException('stream is longer than '
+                                               'file_size')
+                md5.update(data)
+                yield index, data
+
+        parms = (None, file_size, block_size, expiration,
+                 save_token, token_secret, None, limit, None)
+        progress = self.progress(file_size, handler, params)
+        try:
+            status = self.__send_blocks(read_blocks(), None, status, parms,
+                                        pool, limit, progress=progress)
+
+            if received[0] != file_size:
+                raise UpYunClientException('stream is shorter than '
+                                           'file_size')
+            if md5.hexdigest() != file_hash.lower():
+                raise UpYunClientException('file_hash does not match the '
+                                           'stream')
+            if not self.__upload_success(status):
+                raise UpYunServiceException(None, 500, 'Upload failed',
+                                            'Failed to upload the whole '
+                                            'file within retry times')
+            res = self.__end_upload(expiration, save_token, token_secret)
+            if progress is not None:
+                progress.finish()
+            return res
+        finally:
+            if progress is not None:
+                progress.abort()
 
     # --- private API
-    def __init_upload(self, key, value, file_size,
+    def __get_limit(self, concurrency):
+        if concurrency == 'auto':
+            limit = AdaptiveLimit(DEFAULT_CONCURRENCY,
+                                  maximum=MAX_AUTO_CONCURRENCY)
+            return limit, self.__get_pool(limit.maximum)
+        limit = int(concurrency or DEFAULT_CONCURRENCY)
+        if limit < 1:
+            raise UpYunClientException('concurrency must be positive')
+        return limit, self.__get_pool(limit)
+
+    def __get_pool(self, size):
+        # - one pool per instance, shared by concurrent uploads
+        with self.__lock:
+            if self.pool is None:
+                self.pool = WorkerPool(size)
+            else:
+                self.pool.grow(size)
+            return self.pool
+
+    def __journal_path(self, journal, key, value, file_size, block_size):
+        try:
+            path = os.path.realpath(value.name)
+            mtime = os.fstat(value.fileno()).st_mtime
+        except (AttributeError, EnvironmentError, TypeError, ValueError):
+            raise UpYunClientException('journal needs an on-disk file')
+        directory = DEFAULT_JOURNAL_DIR if journal is True else journal
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = '\n'.join([self.bucket, key, path, str(file_size),
+                          repr(mtime), str(block_size)])
+        return os.path.join(directory,
+                            hashlib.md5(b(name)).hexdigest() + '.json')
+
+    def __init_upload(self, key, file_hash, file_size,
                       blocks, expiration, **kwargs):
+        expiration = int((expiration or 1800) + time.time())
         data = {'expiration': expiration,
                 'file_blocks': blocks,
-                'file_hash': make_content_md5(value),
+                'file_hash': file_hash,
                 'file_size': file_size,
                 'path': key,
                 }
@@ -77,37 +253,123 @@ class Multipart(object):
         policy = make_policy(data)
         signature = make_multi_signature(data, self.secret)
         postdata = {'policy': policy, 'signature': signature}
-        return self.__do_http_request(postdata)
+        content = self.__do_http_request(postdata)
+        if 'save_token' not in content or 'token_secret' not in content:
+            raise UpYunServiceException(None, 503, 'Service unavailable',
+                                        'Not enough response datas from api')
+        return (content['save_token'], content['token_secret'], expiration,
+                self.__get_status(content))
 
-    def __block_upload(self, index, parms):
-        status, value, file_size, block_size, expiration,\
-            save_token, token_secret, lock = parms
-        # - if status[index] is already 1, skip it
-        if status[index]:
-            return status
+    def __send_blocks(self, items, read, status, parms, pool, limit,
+                      record=None, progress=None):
+        '''Run blocks through a reader -> hasher/signer -> uploader
+        pipeline and return `status` merged with every response.
+
+        `items` are block indexes turned into (index, data) by `read`, or
+        (index, data) pairs already when `read` is None. Bounded queues
+        between the stages let disk, CPU and network work at once; the
+        busy time of each stage ends up in `stage_timings`.
+        '''
+        timer = StageTimer()
+        start = time.time()
+        blocks = prefetch(read, items, READ_AHEAD, timer, 'read')
+        signed = prefetch(lambda item: self.__sign_block(item, parms),
+                          blocks, READ_AHEAD, timer, 'sign')
+        try:
+            for item, block_status, error in pool.imap_unordered(
+                    lambda item: self.__upload_block(item, parms, timer),
+                    signed, window=limit):
+                if error is not None:
+                    raise error
+                status = [x or y for x, y in zip(status, block_status)]
+                if record:
+                    record.update(status)
+                if progress is not None:
+                    progress.update(len(item[1]['file']))
+        finally:
+            # - stops the reader and the signer when an upload failed
+            signed.close()
+            timings = timer.snapshot()
+            timings['total'] = {'seconds': time.time() - start,
+                                'items': timings.get('upload',
+                                                     {}).get('items', 0)}
+            self.stage_timings = timings
+        return status
+
+    def __read_block(self, index, parms):
+        value, file_size, block_size, _, _, _, lock, _, _ = parms
         start_position = index * block_size
-        if index == len(status) - 1:
-            end_position = file_size
-        else:
-            end_position = start_position + block_size
+        end_position = min(start_position + block_size, file_size)
+        # - positional reads, no lock shared with the other stages
+        return index, pread(value, end_position - start_position,
+                            start_position, lock)
 
-        file_block = self.__read_block(value, start_position,
-                                       end_position, lock)
-        block_hash = make_content_md5(file_block)
+    def __sign_block(self, item, parms):
+        _, _, _, expiration, save_token, token_secret, _, _,\
+            block_hashes = parms
+        index, file_block = item
+        if block_hashes:
+            block_hash = block_hashes[index]
+        else:
+            block_hash = make_content_md5(file_block)
 
         data = {'expiration': expiration, 'block_index': index,
                 'block_hash': block_hash, 'save_token': save_token,
                 }
         policy = make_policy(data)
         signature = make_multi_signature(data, token_secret)
-        postdata = {'policy': policy,
-                    'signature': signature,
-                    'file': file_block,
-                    }
+        return index, {'policy': policy,
+                       'signature': signature,
+                       'file': file_block,
+                       }
+
+    def __upload_block(self, item, parms, timer):
+        limit = parms[7]
+        index, postdata = item
+        adaptive = isinstance(limit, AdaptiveLimit)
+        start = time.time()
+        attempt = 0
+        try:
+            while True:
+                if self.retry is not None:
+                    self.retry.on_request()
+                try:
+                    status = self.__post_block(index, postdata)
+                except (UpYunServiceException, UpYunClientException) as e:
+                    if adaptive:
+                        limit.report(0, False)
+                    delay = self.__retry_delay(attempt, e)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                if adaptive:
+                    limit.report(len(postdata['file']))
+                return status
+        finally:
+            timer.add('upload', time.time() - start)
+
+    def __retry_delay(self, attempt, error):
+        if self.retry is None:
+            return None
+        if isinstance(error, UpYunServiceException):
+            retry_after = parse_retry_after((error.headers or {})
+                                            .get('Retry-After'))
+            return self.retry.next_delay('POST', attempt, status=error.status,
+                                         retry_after=retry_after)
+        return self.retry.next_delay('POST', attempt, error=READ_ERROR)
+
+    def __post_block(self, index, postdata):
+        # - retried by __upload_block alone, at most retry.total times
         resp = self.hp.do_http_pipe('POST', self.host, self.uri,
-                                    files=postdata)
+                                    files=postdata, retry=False)
         content = self.__handle_resp(resp)
-        return self.__get_status(content)
+        status = self.__get_status(content)
+        if not status[index]:
+            raise UpYunServiceException(None, 503, 'Service unavailable',
+                                        'Block %d was not saved' % index)
+        return status
 
     def __end_upload(self, expiration, save_token, token_secret):
         data = {'expiration': expiration, 'save_token': save_token}
@@ -116,15 +378,6 @@ class Multipart(object):
         postdata = {'policy': policy, 'signature': signature}
         return self.__do_http_request(postdata)
 
-    def __find_max_status(self, status_list):
-        max_item = 0
-        max_status = status_list[0]
-        for status in status_list:
-            if sum(status) > max_item:
-                max_item = sum(status)
-                max_status = status
-        return max_status
-
     def __get_status(self, content):
         if 'status' in content and type(content['status']) == list:
             return content['status']
@@ -164,16 +417,3 @@ class Multipart(object):
         if block_size < 100 * 1024:
             block_size = 100 * 1024
         return int(block_size)
-
-    def __read_block(self, f, current_position, end_position, lock,
-                     length=3*8192):
-        data = []
-        lock.acquire()
-        while current_position < end_position:
-            if (current_position + length) > end_position:
-                length = end_position - current_position
-            f.seek(current_position, 0)
-            data.append(f.read(length))
-            current_position += length
-        lock.release()
-        return b('').join(b(data))
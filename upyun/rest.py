@@ -1,11 +1,30 @@
 # -*- coding: utf-8 -*-
 import os
+import math
+import threading
+import time
+from array import array
+from collections import namedtuple
 
 from .modules.sign import make_rest_signature,\
     make_content_md5, encode_msg
-from .modules.exception import UpYunClientException
+from .modules.exception import UpYunClientException, UpYunServiceException
 from .modules.compat import b, str, quote, urlencode, builtin_str
 from .modules.httpipe import cur_dt
+from .modules.fileio import map_file, close_map, preallocate, pwrite,\
+    iter_chunks
+from .modules.pool import WorkerPool
+from .modules.retry import READ_ERROR
+from .modules.checkpoint import DownloadCheckpoint
+from .modules.progress import ProgressReporter
+
+MIN_PART_SIZE = 1024 * 1024
+RESUME_PART_SIZE = 8 * 1024 * 1024
+CHECKPOINT_SUFFIX = '.upyun-ckpt'
+# - the list iteration token the API returns after the last page
+LIST_EOF = 'g2gCZAAEbmV4dGQAA2VvZg'
+DEFAULT_LIST_LIMIT = 1000
+MAX_LIST_LIMIT = 10000
 
 
 def get_fileobj_size(fileobj):
@@ -18,26 +37,156 @@ def get_fileobj_size(fileobj):
     return len(fileobj.getvalue())
 
 
+def make_uri(bucket, key, args=''):
+    _uri = '/%s/%s' % (bucket, key if key[0] != '/' else key[1:])
+    return '%s%s' % (quote(encode_msg(_uri), safe='~/'), args)
+
+
+def make_purge_body(keys, domain):
+    if isinstance(keys, builtin_str):
+        keys = [keys]
+    if isinstance(keys, list):
+        urlfmt = 'http://%s/%s'
+        return '\n'.join([urlfmt % (domain, k if k[0] != '/' else k[1:])
+                          for k in keys]) + '\n'
+    raise UpYunClientException('keys type error')
+
+
+def parse_list(content):
+    if content == '':
+        return []
+    items = content.split('\n')
+    return [dict(zip(['name', 'type', 'size', 'time'],
+            x.split('\t'))) for x in items]
+
+
+ListEntry = namedtuple('ListEntry', ['name', 'type', 'size', 'time'])
+
+
+def int_array(values=()):
+    try:
+        return array('q', values)
+    except ValueError:
+        # - no 64 bit array on Python 2
+        return list(values)
+
+
+class ListResult(object):
+    '''Directory listing stored as parallel columns: `names`, `types`
+    ('N' for files, 'F' for folders, one character per entry) and
+    integer `sizes` and `times` arrays, without one dict per entry.
+    Filtering and sorting return new `ListResult` objects.
+    '''
+    __slots__ = ('names', 'types', 'sizes', 'times')
+
+    def __init__(self, names=None, types='', sizes=None, times=None):
+        self.names = names if names is not None else []
+        self.types = types
+        self.sizes = sizes if sizes is not None else int_array()
+        self.times = times if times is not None else int_array()
+
+    @classmethod
+    def from_content(cls, content):
+        names, types, sizes, times = [], [], [], []
+        if content:
+            for line in content.split('\n'):
+                name, kind, size, mtime = line.split('\t')
+                names.append(name)
+                types.append(kind)
+                sizes.append(int(size))
+                times.append(int(mtime))
+        return cls(names, ''.join(types), int_array(sizes),
+                   int_array(times))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(range(len(self.names))[index])
+        return ListEntry(self.names[index], self.types[index],
+                         self.sizes[index], self.times[index])
+
+    def take(self, indexes):
+        indexes = list(indexes)
+        return ListResult([self.names[i] for i in indexes],
+                          ''.join(self.types[i] for i in indexes),
+                          int_array(self.sizes[i] for i in indexes),
+                          int_array(self.times[i] for i in indexes))
+
+    def filter(self, type=None, min_size=None, max_size=None,
+               prefix=None, suffix=None, since=None, until=None):
+        '''Return the entries matching every given condition; sizes are
+        inclusive bounds, `since` / `until` bound the timestamps.
+        '''
+        names, types, sizes, times = (self.names, self.types,
+                                      self.sizes, self.times)
+        return self.take(
+            i for i in range(len(names))
+            if (type is None or types[i] == type) and
+            (min_size is None or sizes[i] >= min_size) and
+            (max_size is None or sizes[i] <= max_size) and
+            (since is None or times[i] >= since) and
+            (until is None or times[i] <= until) and
+            (prefix is None or names[i].startswith(prefix)) and
+            (suffix is None or names[i].endswith(suffix)))
+
+    def files(self):
+        return self.filter(type='N')
+
+    def folders(self):
+        return self.filter(type='F')
+
+    def sort(self, by='name', reverse=False):
+        column = getattr(self, by + 's')
+        return self.take(sorted(range(len(column)),
+                                key=column.__getitem__, reverse=reverse))
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def to_dicts(self):
+        '''Return the entries in the format of `getlist`.'''
+        return [{'name': n, 'type': t, 'size': str(s), 'time': str(m)}
+                for n, t, s, m in zip(self.names, self.types,
+                                      self.sizes, self.times)]
+
+
+def get_meta_headers(headers):
+    return dict((k[8:].lower(), v) for k, v in headers
+                if k[:8].lower() == 'x-upyun-' and
+                k[8:].lower() != 'uuid' and
+                k[8:].lower() != 'cluster')
+
+
 class UploadObject(object):
-    def __init__(self, fileobj, chunksize=None, handler=None, params=None):
+    def __init__(self, fileobj, chunksize=None, progress=None):
         self.fileobj = fileobj
         self.chunksize = chunksize
         self.totalsize = get_fileobj_size(fileobj)
-        self.readsofar = 0
-        if handler:
-            self.hdr = handler(self.totalsize, params)
+        self.progress = progress
+        self.__last = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        chunk = self.fileobj.read(self.chunksize)
-        if chunk and self.hdr:
-            self.readsofar += len(chunk)
-            if self.readsofar != self.totalsize:
-                self.hdr.update(self.readsofar)
-            else:
-                self.hdr.finish()
+        size = self.chunksize
+        if callable(size):
+            now = time.time()
+            if self.__last is not None:
+                # - the previous chunk was read and sent since then
+                size.report(self.__last[0], now - self.__last[1])
+            size = size()
+        chunk = self.fileobj.read(size)
+        if callable(self.chunksize):
+            self.__last = (len(chunk), now)
+        if chunk and self.progress:
+            self.progress.update(len(chunk))
         return chunk
 
     def __len__(self):
@@ -47,15 +196,59 @@ class UploadObject(object):
         return self.__next__()
 
 
+class RangeWriter(object):
+    '''File-like sink writing one byte range of a download in place,
+    until the `stop` event is set.
+    '''
+    def __init__(self, fd, offset, end, progress=None, lock=None,
+                 stop=None):
+        self.fd = fd
+        self.offset = offset
+        self.end = end
+        self.progress = progress
+        self.lock = lock
+        self.stop = stop
+        self.overflow = False
+
+    def write(self, chunk):
+        if self.stop is not None and self.stop.is_set():
+            raise UpYunClientException('Download cancelled')
+        if self.offset + len(chunk) > self.end + 1:
+            self.overflow = True
+            raise UpYunClientException('Range response is longer than '
+                                       'requested')
+        pwrite(self.fd, chunk, self.offset, self.lock)
+        self.offset += len(chunk)
+        if self.progress:
+            self.progress.update(len(chunk))
+
+
+def check_range(resp, start, end):
+    '''Raise unless `resp` is the 206 answer for bytes `start`-`end`.'''
+    content_range = resp.headers.get('Content-Range') or ''
+    if (resp.status_code == 206 and
+            content_range.startswith('bytes %d-%d/' % (start, end))):
+        return
+    resp.close()
+    raise UpYunServiceException(
+        resp.headers.get('X-Request-Id', 'Unknown'), resp.status_code,
+        'Range Not Satisfied', 'Requested bytes %d-%d, got %s' % (
+            start, end, content_range or 'the whole object'), resp.headers)
+
+
 class UpYunRest(object):
     def __init__(self, bucket, username, password,
-                 endpoint, chunksize, hp):
+                 endpoint, chunksize, hp, hash_cache=None, progress=None,
+                 chunk_sizing=None):
         self.bucket = bucket
         self.username = username
         self.password = password
         self.chunksize = chunksize
         self.endpoint = endpoint
         self.hp = hp
+        self.hash_cache = hash_cache
+        self.progress = progress or ProgressReporter()
+        self.chunk_sizing = chunk_sizing
 
     # --- public API
     def usage(self, key):
@@ -75,25 +268,73 @@ class UpYunRest(object):
             value = b(value)
 
         if checksum is True:
-            headers['Content-MD5'] = make_content_md5(value, self.chunksize)
+            headers['Content-MD5'] = make_content_md5(
+                value, self.__chunksize('hashing'), self.hash_cache)
 
         if secret:
             headers['Content-Secret'] = secret
 
-        if handler and hasattr(value, 'fileno'):
-            value = UploadObject(value, chunksize=self.chunksize,
-                                 handler=handler, params=params)
-
-        h = self.__do_http_request('PUT', key, value, headers)
-        return self.__get_meta_headers(h)
+        mm = None
+        progress = None
+        if hasattr(value, 'fileno'):
+            progress = self.progress(get_fileobj_size(value), handler, params)
+        elif hasattr(value, '__len__'):
+            # - sent at once, reported when done
+            progress = self.progress(len(value), handler, params)
+        if handler is not None and hasattr(value, 'fileno'):
+            value = UploadObject(value, chunksize=self.__chunksize('upload'),
+                                 progress=progress)
+        elif hasattr(value, 'fileno'):
+            # - on-disk files are sent from one mmap'ed buffer with a
+            # - single sendall instead of chunksize reads through Python,
+            # - a monitor alone is told about the whole file once sent
+            mm = map_file(value)
+            if mm is not None:
+                try:
+                    value = memoryview(mm)
+                except TypeError:
+                    close_map(mm)
+                    mm = None
 
-    def get(self, key, value, handler, params):
+        try:
+            h = self.__do_http_request('PUT', key, value, headers)
+            if progress is not None:
+                progress.finish()
+        finally:
+            if mm is not None:
+                value = None
+                close_map(mm)
+            if progress is not None:
+                # - no-op once finished
+                progress.abort()
+        return get_meta_headers(h)
+
+    def get(self, key, value, handler, params, parallel=None,
+            part_size=None, resume=False, checkpoint=None):
         '''
         >>> with open('bar.png', 'wb') as f:
         >>>    up.get('/path/to/bar.png', f)
+        >>>    up.get('/path/to/bar.png', f, parallel=8)
+        >>> up.get('/path/to/bar.png', 'bar.png', resume=True)
         '''
-        return self.__do_http_request('GET', key, of=value, stream=True,
-                                      handler=handler, params=params)
+        if resume:
+            if isinstance(value, (str, builtin_str)):
+                mode = 'r+b' if os.path.exists(value) else 'w+b'
+                with open(value, mode) as f:
+                    return self.__get_parallel(key, f, handler, params,
+                                               parallel or 1, part_size,
+                                               True, checkpoint)
+            if not hasattr(value, 'fileno'):
+                raise UpYunClientException('resume needs a file or a path')
+            return self.__get_parallel(key, value, handler, params,
+                                       parallel or 1, part_size,
+                                       True, checkpoint)
+        if parallel and parallel > 1 and hasattr(value, 'fileno'):
+            return self.__get_parallel(key, value, handler, params,
+                                       parallel, part_size)
+        return self.__do_http_request(
+            'GET', key, of=value, stream=True,
+            progress=lambda size: self.progress(size, handler, params))
 
     def delete(self, key):
         self.__do_http_request('DELETE', key)
@@ -102,28 +343,43 @@ class UpYunRest(object):
         headers = {'Folder': 'true'}
         self.__do_http_request('POST', key, headers=headers)
 
-    def getlist(self, key):
+    def getlist(self, key, compact=False):
         content = self.__do_http_request('GET', key)
-        if content == '':
-            return []
-        items = content.split('\n')
-        return [dict(zip(['name', 'type', 'size', 'time'],
-                x.split('\t'))) for x in items]
+        if compact:
+            return ListResult.from_content(content)
+        return parse_list(content)
+
+    def iterlist(self, key, limit=None, order=None):
+        '''Yield the entries of a directory page by page, fetching `limit`
+        (at most 10000) entries per request, so huge directories are read
+        with constant memory and the caller can stop at any time.
+
+        >>> for item in up.iterlist('/path/', limit=10000):
+        >>>     print(item['name'])
+        '''
+        limit = min(int(limit or DEFAULT_LIST_LIMIT), MAX_LIST_LIMIT)
+        marker = None
+        while True:
+            content, marker = self.__list_page(key, limit, marker, order)
+            for item in parse_list(content):
+                yield item
+            if not marker or marker == LIST_EOF:
+                return
 
     def getinfo(self, key):
         h = self.__do_http_request('HEAD', key)
-        return self.__get_meta_headers(h)
+        return get_meta_headers(h)
+
+    def getetag(self, key):
+        h = self.__do_http_request('HEAD', key)
+        for k, v in h:
+            if k.lower() == 'etag':
+                return v.strip('"')
+        return None
 
     def purge(self, keys, domain):
         domain = domain or '%s.b0.upaiyun.com' % (self.bucket)
-        if isinstance(keys, builtin_str):
-            keys = [keys]
-        if isinstance(keys, list):
-            urlfmt = 'http://%s/%s'
-            urlstr = '\n'.join([urlfmt % (domain, k if k[0] != '/' else k[1:])
-                                for k in keys]) + '\n'
-        else:
-            raise UpYunClientException('keys type error')
+        urlstr = make_purge_body(keys, domain)
 
         method = 'POST'
         host = 'purge.upyun.com'
@@ -140,11 +396,142 @@ class UpYunRest(object):
         return [k[7 + len(domain):] for k in invalid_urls if k]
 
     # --- private API
+    def __chunksize(self, kind):
+        if self.chunk_sizing is None:
+            return self.chunksize
+        return self.chunk_sizing.sizer(kind)
+
+    def __list_page(self, key, limit, marker, order):
+        uri = make_uri(self.bucket, key)
+        headers = {'X-List-Limit': limit}
+        if marker:
+            headers['X-List-Iter'] = marker
+        if order:
+            headers['X-List-Order'] = order
+        self.__set_auth_headers(uri, 'GET', 0, headers)
+        resp = self.hp.do_http_pipe('GET', self.endpoint, uri,
+                                    headers=headers)
+        try:
+            return resp.text, resp.headers.get('x-upyun-list-iter')
+        except Exception as e:
+            raise UpYunClientException(e)
+
+    def __get_parallel(self, key, value, handler, params,
+                       parallel, part_size, resume=False, checkpoint=None):
+        h = self.__do_http_request('HEAD', key)
+        info = get_meta_headers(h)
+        if info.get('file-type') == 'folder':
+            raise UpYunClientException('%s is a folder' % key)
+        totalsize = int(info.get('file-size', 0))
+        value.flush()
+        fd = value.fileno()
+        base = 0 if resume else value.tell()
+
+        if not part_size:
+            part_size = max(MIN_PART_SIZE,
+                            int(math.ceil(totalsize / (parallel * 4.0))))
+            if resume:
+                # - small parts bound what an interruption throws away
+                part_size = min(part_size, RESUME_PART_SIZE)
+        ckpt = None
+        if resume:
+            if checkpoint is None:
+                if not isinstance(getattr(value, 'name', None),
+                                  (str, builtin_str)):
+                    raise UpYunClientException('checkpoint path is '
+                                               'required')
+                checkpoint = value.name + CHECKPOINT_SUFFIX
+            headers = dict((k.lower(), v) for k, v in h)
+            validator = [info.get('file-size'), info.get('file-date'),
+                         headers.get('etag'), headers.get('last-modified')]
+            ckpt = DownloadCheckpoint(checkpoint, key, validator)
+            stale = not ckpt.load()
+            if (not stale and ckpt.done and
+                    os.fstat(fd).st_size <= ckpt.done[-1][1]):
+                # - the file was created anew or truncated since the record
+                # - was written, the ranges it lists are no longer on disk
+                ckpt.remove()
+                ckpt.done = []
+                stale = True
+            if stale:
+                # - no usable record, whatever is on disk is stale
+                os.ftruncate(fd, 0)
+            ranges = ckpt.missing(totalsize, part_size)
+        else:
+            ranges = [(start, min(start + part_size, totalsize) - 1)
+                      for start in range(0, totalsize, part_size)]
+        preallocate(fd, base + totalsize)
+
+        progress = self.progress(totalsize, handler, params,
+                                 ckpt.completed() if ckpt else 0)
+        lock = threading.Lock()
+        stop = threading.Event()
+        try:
+            if ranges:
+                pool = WorkerPool(min(parallel, len(ranges)))
+                results = pool.imap_unordered(
+                    lambda r: self.__get_range(key, fd, base, r[0], r[1],
+                                               progress, lock, ckpt, stop),
+                    ranges)
+                try:
+                    for _, _, error in results:
+                        if error is not None:
+                            raise error
+                finally:
+                    # - skip the ranges not started yet and wait for those
+                    # - in flight, none may write to fd once it is closed
+                    stop.set()
+                    results.close()
+                    pool.close(wait=True)
+            if progress is not None:
+                progress.finish()
+        finally:
+            if progress is not None:
+                progress.abort()
+        value.seek(base + totalsize)
+        if ckpt is not None:
+            ckpt.remove()
+
+    def __get_range(self, key, fd, base, start, end, progress, lock,
+                    ckpt=None, stop=None):
+        first = start
+        attempt = 0
+        while True:
+            writer = RangeWriter(fd, base + start, base + end,
+                                 progress, lock, stop)
+            headers = {'Range': 'bytes=%d-%d' % (start, end)}
+            try:
+                self.__do_http_request(
+                    'GET', key, headers=headers, of=writer, stream=True,
+                    check=lambda resp: check_range(resp, start, end))
+            except UpYunClientException:
+                # - resume the range from what was written so far, unless
+                # - the body did not fit the range or another range failed
+                # - and the download was given up
+                delay = None
+                if (self.hp.retry is not None and not writer.overflow and
+                        not (stop and stop.is_set())):
+                    delay = self.hp.retry.next_delay('GET', attempt,
+                                                     error=READ_ERROR)
+                if delay is None:
+                    if ckpt is not None and writer.offset > base + first:
+                        ckpt.add(first, writer.offset - base - 1)
+                    raise
+                start = writer.offset - base
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if writer.offset != base + end + 1:
+                raise UpYunClientException('Range response is shorter '
+                                           'than requested')
+            if ckpt is not None:
+                ckpt.add(first, end)
+            return
+
     def __do_http_request(self, method, key,
                           value=None, headers=None, of=None, args='',
-                          stream=False, handler=None, params=None):
-        _uri = '/%s/%s' % (self.bucket, key if key[0] != '/' else key[1:])
-        uri = '%s%s' % (quote(encode_msg(_uri), safe='~/'), args)
+                          stream=False, progress=None, check=None):
+        uri = make_uri(self.bucket, key, args)
 
         if headers is None:
             headers = {}
@@ -167,33 +554,42 @@ class UpYunRest(object):
 
         resp = self.hp.do_http_pipe(method, self.endpoint, uri,
                                     value, headers, stream)
-        return self.__handle_resp(resp, method, of, handler, params)
+        if check is not None:
+            check(resp)
+        return self.__handle_resp(resp, method, of, progress)
 
     def __handle_resp(self, resp, method=None, of=None,
-                      handler=None, params=None, uri=None):
+                      progress=None, uri=None):
         content = None
         try:
             if method == 'GET' and of:
-                readsofar = 0
                 try:
                     totalsize = int(resp.headers['content-length'])
                 except (KeyError, TypeError):
                     totalsize = 0
 
-                hdr = None
-                if handler and totalsize > 0:
-                    hdr = handler(totalsize, params)
-
-                for chunk in resp.iter_content(self.chunksize):
-                    if chunk and hdr:
-                        readsofar += len(chunk)
-                        if readsofar != totalsize:
-                            hdr.update(readsofar)
-                        else:
-                            hdr.finish()
-                    if not chunk:
-                        break
-                    of.write(chunk)
+                if progress and totalsize > 0:
+                    progress = progress(totalsize)
+                else:
+                    progress = None
+                chunksize = self.__chunksize('download')
+                if callable(chunksize):
+                    chunks = iter_chunks(
+                        lambda n: resp.raw.read(n, decode_content=True),
+                        chunksize)
+                else:
+                    chunks = resp.iter_content(chunksize)
+                try:
+                    for chunk in chunks:
+                        if chunk and progress:
+                            progress.update(len(chunk))
+                        if not chunk:
+                            break
+                        of.write(chunk)
+                finally:
+                    if progress is not None:
+                        # - no-op once the whole body was received
+                        progress.abort()
             elif method == 'GET':
                 content = resp.text
             elif method == 'PUT' or method == 'HEAD':
@@ -204,12 +600,6 @@ class UpYunRest(object):
             raise UpYunClientException(e)
         return content
 
-    def __get_meta_headers(self, headers):
-        return dict((k[8:].lower(), v) for k, v in headers
-                    if k[:8].lower() == 'x-upyun-' and
-                    k[8:].lower() != 'uuid' and
-                    k[8:].lower() != 'cluster')
-
     def __set_auth_headers(self, playload,
                            method=None, length=0, headers=None):
         if headers is None:
@@ -220,5 +610,6 @@ class UpYunRest(object):
                                         self.password, method, playload,
                                         dt, length)
 
+        headers['Date'] = dt
         headers['Authorization'] = signature
         return headers
@@ -2,6 +2,8 @@
 import hashlib
 import json
 import os
+import threading
+from collections import namedtuple
 
 from .rest import UpYunRest
 from .form import FormUpload
@@ -9,23 +11,43 @@ from .multi import Multipart
 from .av import AvPretreatment
 
 from .modules.httpipe import UpYunHttp
-from .modules.exception import UpYunClientException
+from .modules.exception import UpYunClientException, UpYunServiceException
 from .modules.compat import b, builtin_str
 from .modules.sign import make_content_md5, encode_msg
 from .modules.check import has_object
+from .modules.tracer import DebugLogger
+from .modules.endpoint import EndpointSelector, ED_SMART
+from .modules.pool import WorkerPool
+from .modules.cache import MetaCache
+from .modules.hashcache import HashCache
+from .modules.progress import ProgressReporter, DEFAULT_PROGRESS_INTERVAL
+from .modules.fileio import ChunkSizing
+from .modules.purge import PurgeBatcher, DEFAULT_PURGE_DELAY,\
+    DEFAULT_PURGE_URLS, DEFAULT_PURGE_BYTES
 
 __version__ = '2.3.2'
 
 ED_LIST = ('v%d.api.upyun.com' % ed for ed in range(4))
 ED_AUTO, ED_TELECOM, ED_CNC, ED_CTT = ED_LIST
+ED_SMART_HOSTS = (ED_TELECOM, ED_CNC, ED_CTT, ED_AUTO)
 
 DEFAULT_CHUNKSIZE = 8192
+# - matches the default connection pool size of requests
+DEFAULT_BULK_CONCURRENCY = 10
+
+BulkResult = namedtuple('BulkResult', ['key', 'result', 'error'])
+SyncReport = namedtuple('SyncReport', ['upload', 'delete', 'unchanged',
+                                       'errors'])
 
 
 class UpYun(object):
     def __init__(self, bucket, username=None, password=None, secret=None,
                  timeout=None, endpoint=None, chunksize=None, debug=False,
-                 read_timeout=None):
+                 read_timeout=None, pool_connections=None, pool_maxsize=None,
+                 pool_block=False, keepalive=None, retry=None, cache=None,
+                 hash_cache=None, monitor=None,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL,
+                 progress_step=None):
         super(UpYun, self).__init__()
         self.bucket = bucket or os.getenv('UPYUN_BUCKET')
         self.username = username or os.getenv('UPYUN_USERNAME')
@@ -33,6 +55,17 @@ class UpYun(object):
         self.password = (hashlib.md5(b(password)).hexdigest()
                          if password else None)
         self.endpoint = endpoint or ED_AUTO
+        self.selector = None
+        if self.endpoint == ED_SMART:
+            self.selector = EndpointSelector(ED_SMART_HOSTS)
+        elif isinstance(self.endpoint, EndpointSelector):
+            self.selector, self.endpoint = self.endpoint, ED_SMART
+        # - 'auto' or a ChunkSizing: each stream tunes its own chunk size
+        if chunksize == 'auto':
+            chunksize = ChunkSizing()
+        self.chunk_sizing = None
+        if isinstance(chunksize, ChunkSizing):
+            self.chunk_sizing, chunksize = chunksize, None
         self.chunksize = chunksize or DEFAULT_CHUNKSIZE
         self.secret = secret or os.getenv('UPYUN_SECRET')
         self.timeout = timeout or 60
@@ -40,33 +73,64 @@ class UpYun(object):
             self.requests_timeout = (self.timeout, read_timeout)
         else:
             self.requests_timeout = self.timeout
-        self.hp = UpYunHttp(self.requests_timeout, debug)
+        # - any other true value (e.g. debug=1) asks for the default logger
+        if debug and not hasattr(debug, 'log'):
+            debug = DebugLogger()
+        if cache is True:
+            cache = MetaCache()
+        self.cache = cache or None
+        if hash_cache is True:
+            hash_cache = HashCache()
+        self.hash_cache = hash_cache or None
+        self.monitor = monitor
+        self.progress = ProgressReporter(monitor, progress_interval,
+                                         progress_step)
+        self.debug = debug or None
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
+        self.hp = UpYunHttp(self.requests_timeout, self.debug,
+                            pool_connections=pool_connections,
+                            pool_maxsize=pool_maxsize,
+                            pool_block=pool_block, keepalive=keepalive,
+                            retry=retry, selector=self.selector)
 
         if self.username and self.password:
             self.up_rest = UpYunRest(self.bucket, self.username,
                                      self.password, self.endpoint,
-                                     self.chunksize, self.hp)
+                                     self.chunksize, self.hp,
+                                     self.hash_cache, self.progress,
+                                     self.chunk_sizing)
             self.av = AvPretreatment(self.bucket, self.username,
                                      self.password, self.chunksize,
                                      self.hp)
         if self.secret:
             self.up_multi = Multipart(self.bucket, self.secret,
-                                      self.endpoint, self.hp)
+                                      self.endpoint, self.hp,
+                                      self.hash_cache, self.progress)
             self.up_form = FormUpload(self.bucket, self.secret,
-                                      self.endpoint, self.hp)
+                                      self.endpoint, self.hp, self.progress)
+
+        if self.debug:
+            self.debug.log('init', bucket=bucket, username=username,
+                           password=password, secret=secret,
+                           timeout=timeout, endpoint=endpoint,
+                           chunksize=chunksize)
 
-        if debug:
-            self.__init_debug_log(bucket=bucket, username=username,
-                                  password=password, secret=secret,
-                                  timeout=timeout, endpoint=endpoint,
-                                  chunksize=chunksize, debug=debug)
+    def endpoint_scores(self):
+        '''Return the latency / error statistics of every candidate host
+        when running with `endpoint=ED_SMART`.
+        '''
+        if self.selector is None:
+            return {}
+        return self.selector.scores()
 
-    def __init_debug_log(self, **kwargs):
-        with open('debug.log', 'w') as f:
-            f.write('### Running in debug mode ###\n\n\n')
-            f.write('## Initial params ##\n\n')
-            f.write('\n'.join(map(lambda kv: '%s: %s'
-                              % (kv[0], kv[1]), kwargs.items())))
+    def cache_stats(self):
+        '''Return the hit / miss / eviction counters and the size of the
+        metadata cache, when running with `cache`.
+        '''
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
 
     # --- public rest API
     @has_object('up_rest')
@@ -76,44 +140,286 @@ class UpYun(object):
     def put(self, key, value, checksum=False, headers=None,
             handler=None, params=None, secret=None,
             multipart=False, block_size=None, form=False,
-            expiration=None, **kwargs):
+            expiration=None, concurrency=None, journal=None,
+            file_size=None, file_hash=None, **kwargs):
         if (multipart or form) and not self.secret:
             raise UpYunClientException('You have to specify form secret with '
                                        'multipart upload method')
-
-        # - priority: rest > form > multipart
-        if form and hasattr(value, 'fileno'):
-            return self.up_form.upload(key, value, expiration, **kwargs)
-        if multipart and hasattr(value, 'fileno'):
-            return self.up_multi.upload(key, value,
-                                        block_size, expiration, **kwargs)
-        return self.up_rest.put(key, value, checksum,
-                                headers, handler, params, secret)
+        try:
+            # - priority: rest > form > multipart
+            if form and hasattr(value, 'fileno'):
+                return self.up_form.upload(key, value, expiration, handler,
+                                           params, **kwargs)
+            # - streams of known size, e.g. pipes or generators
+            if multipart and file_size is not None:
+                return self.up_multi.upload_stream(key, value, file_size,
+                                                   file_hash, block_size,
+                                                   expiration, concurrency,
+                                                   handler, params, **kwargs)
+            if multipart and hasattr(value, 'fileno'):
+                return self.up_multi.upload(key, value, block_size,
+                                            expiration, concurrency, journal,
+                                            handler, params, **kwargs)
+            return self.up_rest.put(key, value, checksum,
+                                    headers, handler, params, secret)
+        finally:
+            self.__invalidate(key)
 
     @has_object('up_rest')
-    def get(self, key, value=None, handler=None, params=None):
-        return self.up_rest.get(key, value, handler, params)
+    def get(self, key, value=None, handler=None, params=None,
+            parallel=None, part_size=None, resume=False, checkpoint=None):
+        return self.up_rest.get(key, value, handler, params,
+                                parallel, part_size, resume, checkpoint)
 
     @has_object('up_rest')
     def delete(self, key):
-        self.up_rest.delete(key)
+        try:
+            self.up_rest.delete(key)
+        finally:
+            self.__invalidate(key)
 
     @has_object('up_rest')
     def mkdir(self, key):
-        self.up_rest.mkdir(key)
+        try:
+            self.up_rest.mkdir(key)
+        finally:
+            self.__invalidate(key)
+
+    @has_object('up_rest')
+    def getlist(self, key='/', compact=False):
+        if self.cache is None:
+            return self.up_rest.getlist(key, compact)
+        ckey = ('compact' if compact else 'list', '/' + key.strip('/'))
+        generation = self.cache.generation(ckey)
+        res = self.cache.get(ckey)
+        if res is None:
+            res = self.up_rest.getlist(key, compact)
+            # - not kept if a write invalidated it meanwhile
+            self.cache.set(ckey, res, generation)
+        # - entries are plain dicts the caller may modify
+        return res if compact else [dict(e) for e in res]
 
     @has_object('up_rest')
-    def getlist(self, key='/'):
-        return self.up_rest.getlist(key)
+    def iterlist(self, key='/', limit=None, order=None):
+        return self.up_rest.iterlist(key, limit, order)
 
     @has_object('up_rest')
     def getinfo(self, key):
-        return self.up_rest.getinfo(key)
+        if self.cache is None:
+            return self.up_rest.getinfo(key)
+        ckey = ('info', '/' + key.strip('/'))
+        generation = self.cache.generation(ckey)
+        res = self.cache.get(ckey)
+        if res is None:
+            res = self.up_rest.getinfo(key)
+            self.cache.set(ckey, res, generation)
+        return dict(res)
 
     @has_object('up_rest')
     def purge(self, keys, domain=None):
         return self.up_rest.purge(keys, domain)
 
+    @has_object('up_rest')
+    def purge_batcher(self, max_delay=DEFAULT_PURGE_DELAY,
+                      max_urls=DEFAULT_PURGE_URLS,
+                      max_bytes=DEFAULT_PURGE_BYTES):
+        '''Return a `PurgeBatcher` sending its batches through `purge`.
+
+        >>> with up.purge_batcher(max_delay=2) as batcher:
+        >>>     ticket = batcher.submit(['/a.png', '/b.png'])
+        >>> print(ticket.result())
+        '''
+        return PurgeBatcher(self.up_rest.purge, max_delay, max_urls,
+                            max_bytes)
+
+    # --- bulk API
+    def put_many(self, items, concurrency=None, window=None, paths=False,
+                 **kwargs):
+        '''Upload `(key, value)` pairs concurrently, `value` being anything
+        `put` accepts, strings being uploaded as content. With `paths`,
+        every `value` is instead the path of a local file to upload.
+        Yield a `BulkResult` per item as it completes; extra arguments
+        are passed to `put`.
+
+        >>> for r in up.put_many([('/a.png', 'a.png'), ('/b.png', 'b.png')],
+        >>>                      paths=True):
+        >>>     if r.error:
+        >>>         print(r.key, r.error)
+        '''
+        def put(item):
+            key, value = item
+            if paths:
+                with open(value, 'rb') as f:
+                    return self.put(key, f, **kwargs)
+            return self.put(key, value, **kwargs)
+        return self.__bulk(put, items, concurrency, window)
+
+    @has_object('up_rest')
+    def get_many(self, items, concurrency=None, window=None, **kwargs):
+        '''Download keys concurrently. Items are keys, whose content is
+        returned as the result, or `(key, value)` pairs where `value` is
+        a local file path or a writable file object.
+        '''
+        def get(item):
+            key, value = item if isinstance(item, tuple) else (item, None)
+            if isinstance(value, builtin_str):
+                with open(value, 'wb') as f:
+                    return self.get(key, f, **kwargs)
+            return self.get(key, value, **kwargs)
+        return self.__bulk(get, items, concurrency, window)
+
+    @has_object('up_rest')
+    def delete_many(self, keys, concurrency=None, window=None):
+        return self.__bulk(self.delete, keys, concurrency, window)
+
+    @has_object('up_rest')
+    def getinfo_many(self, keys, concurrency=None, window=None):
+        return self.__bulk(self.getinfo, keys, concurrency, window)
+
+    @has_object('up_rest')
+    def walk(self, prefix='/', concurrency=None, maxdepth=None,
+             predicate=None, onerror=None):
+        '''Yield `(dirpath, dirs, files)` for every directory under
+        `prefix`, like `os.walk`, listing up to `concurrency` directories
+        at once. `dirs` and `files` are entries as returned by `getlist`,
+        and directories come in completion order. `maxdepth` limits how
+        many levels below `prefix` are listed (0: only `prefix`).
+        `predicate` is a path prefix, or a callable taking the full path
+        of an entry (directories end with '/'), that entries must match;
+        directories leading to the prefix are still descended into.
+        Listing errors are raised, unless `onerror` is given: it is then
+        called with each error and the walk goes on.
+
+        >>> for dirpath, dirs, files in up.walk('/logs/', concurrency=32):
+        >>>     print(dirpath, sum(int(f['size']) for f in files))
+        '''
+        prefix = '/' + prefix.strip('/') + '/' if prefix.strip('/') else '/'
+        if isinstance(predicate, builtin_str):
+            path_prefix = predicate
+            predicate = (lambda path: path.startswith(path_prefix) or
+                         (path[-1] == '/' and path_prefix.startswith(path)))
+
+        def listdir(item):
+            dirs, files = [], []
+            for entry in self.up_rest.iterlist(item[0], limit=10000):
+                kind = dirs if entry['type'] == 'F' else files
+                if entry['type'] == 'F':
+                    path = item[0] + entry['name'] + '/'
+                else:
+                    path = item[0] + entry['name']
+                if predicate is None or predicate(path):
+                    kind.append(entry)
+            return dirs, files
+
+        def children(item, result):
+            path, depth = item
+            if maxdepth is not None and depth >= maxdepth:
+                return []
+            return [(path + d['name'] + '/', depth + 1) for d in result[0]]
+
+        concurrency = concurrency or DEFAULT_BULK_CONCURRENCY
+        results = self.__get_pool(concurrency).imap_tree(
+            listdir, [(prefix, 0)], children, concurrency)
+        try:
+            for item, result, error in results:
+                if error is not None:
+                    if onerror is None:
+                        raise error
+                    onerror(error)
+                    continue
+                yield (item[0],) + result
+        finally:
+            # - skip the directories still queued when the caller stops
+            results.close()
+
+    def sync(self, local_dir, remote_prefix='/', delete=False,
+             checksum=False, dry_run=False, concurrency=None, **kwargs):
+        '''Mirror the files under `local_dir` to `remote_prefix`,
+        uploading only the files missing remotely or changed since: a
+        different size, or a local mtime later than the remote upload
+        time. With `checksum`, files of the same size are compared by
+        MD5 against the remote ETag instead of by time. With `delete`,
+        remote files and folders absent locally are removed.
+
+        Return a `SyncReport` of the keys to upload, to delete and left
+        unchanged, plus the `BulkResult` of every failed operation;
+        `dry_run` only computes the plan. Extra arguments are passed to
+        `put`.
+
+        >>> report = up.sync('build/', '/static/', delete=True)
+        >>> print(len(report.upload), len(report.errors))
+        '''
+        prefix = ('/' + remote_prefix.strip('/') + '/'
+                  if remote_prefix.strip('/') else '/')
+        local, local_dirs = {}, set()
+        for root, dirs, files in os.walk(local_dir):
+            rel = os.path.relpath(root, local_dir)
+            base = prefix
+            if rel != os.curdir:
+                base += rel.replace(os.sep, '/') + '/'
+                local_dirs.add(base[:-1])
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                local[base + name] = (path, st.st_size, int(st.st_mtime))
+
+        def onerror(error):
+            # - a missing remote prefix is an empty one
+            if not (isinstance(error, UpYunServiceException) and
+                    error.status == 404):
+                raise error
+        remote, remote_dirs = {}, []
+        for dirpath, dirs, files in self.walk(prefix, concurrency,
+                                              onerror=onerror):
+            for f in files:
+                remote[dirpath + f['name']] = (int(f['size']),
+                                               int(f['time']))
+            remote_dirs.extend(dirpath + d['name'] for d in dirs)
+
+        upload, unchanged, compare = [], [], []
+        for key, (path, size, mtime) in local.items():
+            if key not in remote or remote[key][0] != size:
+                upload.append(key)
+            elif checksum:
+                compare.append(key)
+            elif mtime > remote[key][1]:
+                upload.append(key)
+            else:
+                unchanged.append(key)
+
+        def same(key):
+            with open(local[key][0], 'rb') as f:
+                return (self.up_rest.getetag(key) ==
+                        make_content_md5(f, cache=self.hash_cache))
+        for r in self.__bulk(same, compare, concurrency, None):
+            # - when in doubt, upload again
+            (unchanged if r.result else upload).append(r.key)
+
+        extra = []
+        if delete:
+            extra = sorted(set(remote) - set(local))
+            # - folders can only be removed once empty, deepest first
+            extra += sorted((d for d in remote_dirs if d not in local_dirs),
+                            key=lambda d: d.count('/'), reverse=True)
+        report = SyncReport(sorted(upload), extra, sorted(unchanged), [])
+        if dry_run:
+            return report
+
+        errors = report.errors
+        errors.extend(r for r in self.put_many(
+            ((k, local[k][0]) for k in report.upload), concurrency,
+            paths=True, **kwargs)
+            if r.error is not None)
+        files = [k for k in extra if k in remote]
+        errors.extend(r for r in self.delete_many(files, concurrency)
+                      if r.error is not None)
+        for key in extra[len(files):]:
+            try:
+                self.delete(key)
+            except Exception as e:
+                errors.append(BulkResult(key, None, e))
+        return report
+
     # --- video pretreatment API
     @has_object('av')
     def pretreat(self, tasks, source, notify_url=''):
@@ -151,6 +457,44 @@ class UpYun(object):
                 raise UpYunClientException('Given not correct sources in task')
         return self.av.pretreat(tasks, 'upyun', notify_url, 'compress')
 
+    # --- private API
+    def __invalidate(self, key):
+        if self.cache is None:
+            return
+        path = '/' + key.strip('/')
+        keys = [('info', path), ('list', path), ('compact', path)]
+        # - writes change the listing of the parent folder, and may create
+        # - the missing folders above it
+        while path != '/':
+            path = path.rsplit('/', 1)[0] or '/'
+            keys += [('list', path), ('compact', path)]
+        self.cache.invalidate(*keys)
+
+    def __get_pool(self, size):
+        # - one pool per instance, shared by the bulk operations, the
+        # - window of each call bounds how many of its items are in flight
+        with self.__pool_lock:
+            if self.__pool is None:
+                self.__pool = WorkerPool(size)
+            else:
+                self.__pool.grow(size)
+            return self.__pool
+
+    def __bulk(self, func, items, concurrency, window):
+        # - `items` is consumed lazily, at most `window` items (default:
+        # - `concurrency`) are in flight at any time
+        concurrency = concurrency or DEFAULT_BULK_CONCURRENCY
+        window = window or concurrency
+        results = self.__get_pool(concurrency).imap_unordered(func, items,
+                                                              window)
+        try:
+            for item, result, error in results:
+                key = item[0] if isinstance(item, tuple) else item
+                yield BulkResult(key, result, error)
+        finally:
+            # - skip the items still queued when the caller stops early
+            results.close()
+
 
 # --- no use yet, need developing
 def verify_put_sign(value, secret):